@@ -0,0 +1,20 @@
+"""
+VAD 能量计算的 Numba 加速实现（可选依赖）
+
+numba 不可用时 import 失败，由 asr.py 回退到 NumPy 实现
+"""
+from __future__ import annotations
+
+import math
+
+from numba import njit
+
+
+@njit(cache=True, fastmath=True)
+def rms_int16(w):
+    """int16 PCM 的 RMS：平方、求和、开方融合为一次遍历"""
+    s = 0.0
+    for i in range(w.shape[0]):
+        v = float(w[i])
+        s += v * v
+    return math.sqrt(s / max(w.shape[0], 1))
@@ -1,6 +1,6 @@
 """
 Whisper ASR 模块
-- 单例加载 Whisper small 模型（GPU/FP16 优先，CPU 降级）
+- 单例加载 Whisper small 模型（GPU int8_float16 优先，CPU int8 降级）
 - 简单 VAD（能量阈值过滤静音）
 - 推理超时与错误处理
 """
@@ -9,6 +9,8 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
+import threading
+from collections.abc import Awaitable, Callable, Iterator
 from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
@@ -18,12 +20,41 @@ logger = logging.getLogger(__name__)
 # 全局单例
 _model = None
 _backend = None
-_executor = ThreadPoolExecutor(max_workers=1)
+_executor: ThreadPoolExecutor | None = None
+
+# 输入音频格式：16kHz mono int16
+SAMPLE_RATE = 16000
+BYTES_PER_SAMPLE = 2
+BYTES_PER_MS = SAMPLE_RATE * BYTES_PER_SAMPLE // 1000  # 32
 
 # 配置
 WHISPER_MODEL = os.getenv("WHISPER_MODEL", "small")
 ENERGY_THRESHOLD = float(os.getenv("WHISPER_ENERGY_THRESHOLD", "30.0"))
 ASR_TIMEOUT = float(os.getenv("WHISPER_TIMEOUT", "8.0"))
+# CTranslate2 计算类型：auto 由 CT2 自选最快的受支持类型；置空则按设备取默认（见 _detect_device）
+COMPUTE_TYPE = os.getenv("WHISPER_COMPUTE_TYPE", "auto")
+# CPU 推理并发数（CUDA 下固定为 1，GPU 是瓶颈）
+ASR_WORKERS = int(os.getenv("ASR_WORKERS", "4"))
+# 解码参数：流式短窗口默认贪心解码，需要时可改回 beam search
+BEAM_SIZE = int(os.getenv("WHISPER_BEAM_SIZE", "1"))
+CONDITION_ON_PREVIOUS_TEXT = os.getenv("WHISPER_CONDITION_ON_PREVIOUS_TEXT", "0") == "1"
+# 流式窗口：小帧攒成数秒窗口再推理，窗口间保留少量重叠防止切断单词
+WINDOW_BYTES = int(float(os.getenv("ASR_WINDOW_SECONDS", "3.0")) * SAMPLE_RATE) * BYTES_PER_SAMPLE
+FLUSH_INTERVAL = float(os.getenv("ASR_FLUSH_SECONDS", "1.5"))
+OVERLAP_BYTES = int(os.getenv("ASR_OVERLAP_MS", "500")) * BYTES_PER_MS
+# 推理积压时合并的窗口总长上限：合并后仍在同一个 ASR_TIMEOUT 内推理，太长（如 30s）在 CPU 上容易超时，
+# 整段积压随之丢弃而推理线程仍被占着，延迟反而越拖越大
+MAX_MERGE_BYTES = int(float(os.getenv("ASR_MAX_MERGE_SECONDS", "6.0")) * SAMPLE_RATE) * BYTES_PER_SAMPLE
+# VAD 粗判：样本数不少于该值时先按步长抽取计算
+QUICK_GATE_STRIDE = 8
+QUICK_GATE_MIN_SAMPLES = SAMPLE_RATE
+# NumPy 回退计算 RMS 时每块的样本数（float32 临时数组 64KB）
+RMS_CHUNK = 16384
+# 单次推理最大样本数（30s @ 16kHz），超出时退化为临时分配
+MAX_FRAME_SAMPLES = SAMPLE_RATE * 30
+
+# 推理线程私有的 float32 复用缓冲（归一化在推理线程内完成，超时后残留的推理不会与下一帧争用）
+_local = threading.local()
 
 try:
     from faster_whisper import WhisperModel
@@ -44,29 +75,50 @@ try:
 except ImportError:
     _HAS_TORCH = False
 
+try:
+    from echo._vad import rms_int16 as _rms_int16
+    _HAS_NUMBA = True
+except ImportError:
+    _HAS_NUMBA = False
+
 
 def _detect_device() -> tuple[str, str]:
-    """检测可用设备和计算类型"""
-    if not _HAS_TORCH:
-        return "cpu", "int8"
+    """
+    检测可用设备和计算类型
 
-    import torch
-    if torch.cuda.is_available():
-        return "cuda", "float16"
-    if hasattr(torch.backends, "mps") and torch.backends.mps.is_available():
-        return "mps", "float16"
+    CTranslate2 不支持 MPS，Apple 芯片走 CPU int8
+    """
+    if _HAS_TORCH and torch.cuda.is_available():
+        return "cuda", "int8_float16"
     return "cpu", "int8"
 
 
 def _load_model() -> None:
-    """加载 Whisper 模型（启动时调用）"""
-    global _model, _backend
+    """加载 Whisper 模型并创建推理线程池（启动时调用）"""
+    global _model, _backend, _executor
+
+    device, default_compute_type = _detect_device()
+    compute_type = COMPUTE_TYPE or default_compute_type
+
+    cpu_count = os.cpu_count() or 2
+    workers = 1 if device == "cuda" else max(2, min(cpu_count, ASR_WORKERS))
+    _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="asr")
 
-    device, compute_type = _detect_device()
-    logger.info(f"Loading Whisper {WHISPER_MODEL} on {device} with {compute_type}")
+    # 预先拉起所有推理线程，避免首帧承担线程创建开销（Barrier 保证每个任务占住一个新线程）
+    barrier = threading.Barrier(workers)
+    list(_executor.map(lambda _: barrier.wait(), range(workers)))
+
+    logger.info(f"Loading Whisper {WHISPER_MODEL} on {device} with {compute_type}, {workers} workers")
 
     if _HAS_FASTER:
-        _model = WhisperModel(WHISPER_MODEL, device=device, compute_type=compute_type)
+        # CTranslate2 的并发数与线程池对齐，CPU 线程按 worker 均分
+        _model = WhisperModel(
+            WHISPER_MODEL,
+            device=device,
+            compute_type=compute_type,
+            cpu_threads=0 if device == "cuda" else max(1, cpu_count // workers),
+            num_workers=workers,
+        )
         _backend = "faster"
         logger.info("Using faster-whisper backend")
     elif _HAS_OPENAI:
@@ -77,30 +129,118 @@ def _load_model() -> None:
         logger.error("No Whisper backend available")
 
 
+def _rms(wave: np.ndarray) -> float:
+    """int16 数组的 RMS（Numba 优先，NumPy 回退）"""
+    if _HAS_NUMBA:
+        return float(_rms_int16(wave))
+    # 分块转 float32 再 dot：临时数组只有一块大小（留在缓存里），不随窗口长度放大；
+    # float32 的精度对能量门限足够
+    acc = 0.0
+    for i in range(0, wave.size, RMS_CHUNK):
+        w = wave[i:i + RMS_CHUNK].astype(np.float32)
+        acc += float(np.dot(w, w))
+    return float(np.sqrt(acc / wave.size))
+
+
 def _compute_energy(wave: np.ndarray) -> float:
-    """计算音频帧的能量（RMS）"""
+    """
+    计算音频帧的能量（RMS）
+
+    长窗口先在 8 倍抽取的样本上粗判，明显低于阈值直接返回（静音为主的课堂音频大多在此结束），
+    接近阈值时再用全部样本复核
+    """
     if wave.size == 0:
         return 0.0
-    return float(np.sqrt(np.mean(np.square(wave.astype(np.float32)))))
+    if wave.size >= QUICK_GATE_MIN_SAMPLES:
+        quick = _rms(wave[::QUICK_GATE_STRIDE])
+        if quick < ENERGY_THRESHOLD * 0.9:
+            return quick
+    return _rms(wave)
+
+
+def _normalize(wave: np.ndarray) -> np.ndarray:
+    """int16 → [-1, 1] float32，写入当前线程的复用缓冲"""
+    n = wave.size
+    if n > MAX_FRAME_SAMPLES:
+        return wave * np.float32(1.0 / 32768.0)
+
+    buf = getattr(_local, "buf", None)
+    if buf is None:
+        buf = _local.buf = np.empty(MAX_FRAME_SAMPLES, dtype=np.float32)
+    out = buf[:n]
+    np.multiply(wave, np.float32(1.0 / 32768.0), out=out, casting="unsafe")
+    return out
 
 
-def _do_transcribe_sync(audio: np.ndarray) -> str:
-    """同步推理（在线程池中执行）"""
+def _iter_transcribe_sync(wave: np.ndarray) -> Iterator[str]:
+    """
+    同步推理（在线程池中执行），逐段产出文本
+
+    faster-whisper 的 segments 是惰性生成器，迭代时才真正解码，
+    逐段产出可以让调用方在整窗解码完成前拿到首个片段
+    """
+    audio = _normalize(wave)
     if _backend == "faster":
-        segments, _ = _model.transcribe(audio, language="en", beam_size=5)
-        return " ".join(seg.text.strip() for seg in segments).strip()
+        segments, _ = _model.transcribe(
+            audio,
+            language="en",
+            beam_size=BEAM_SIZE,
+            best_of=1,
+            condition_on_previous_text=CONDITION_ON_PREVIOUS_TEXT,
+            vad_filter=False,  # 已在 transcribe() 中做过能量门限
+            without_timestamps=True,
+            temperature=0.0,
+        )
+        for seg in segments:
+            text = seg.text.strip()
+            if text:
+                yield text
     elif _backend == "openai":
         result = _model.transcribe(audio, language="en")
-        return str(result.get("text", "")).strip()
-    return ""
+        text = str(result.get("text", "")).strip()
+        if text:
+            yield text
+
+
+def _do_transcribe_sync(wave: np.ndarray) -> str:
+    """同步推理（在线程池中执行），返回整段文本"""
+    return " ".join(_iter_transcribe_sync(wave))
+
+
+async def _stream_transcribe(
+    wave: np.ndarray,
+    on_partial: Callable[[str], Awaitable[None]],
+) -> str:
+    """推理线程逐段投递到事件循环，每到一段回调一次（累计文本），返回整段文本"""
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue[str | None] = asyncio.Queue()
+
+    def _pump() -> None:
+        try:
+            for text in _iter_transcribe_sync(wave):
+                loop.call_soon_threadsafe(queue.put_nowait, text)
+        finally:
+            loop.call_soon_threadsafe(queue.put_nowait, None)
+
+    future = loop.run_in_executor(_executor, _pump)
+    parts: list[str] = []
+    while (text := await queue.get()) is not None:
+        parts.append(text)
+        await on_partial(" ".join(parts))
+    await future  # 传播推理线程中的异常
+    return " ".join(parts)
 
 
-async def transcribe(pcm_bytes: bytes) -> dict[str, any]:
+async def transcribe(
+    pcm_bytes: bytes | bytearray | memoryview,
+    on_partial: Callable[[str], Awaitable[None]] | None = None,
+) -> dict[str, any]:
     """
     转录音频帧
 
     Args:
-        pcm_bytes: 16kHz mono PCM int16 二进制数据
+        pcm_bytes: 16kHz mono PCM int16 二进制数据（零拷贝读取；可变缓冲在调用期间不得修改）
+        on_partial: 可选回调，每解码出一个片段即以累计文本调用一次（用于流式字幕）
 
     Returns:
         {
@@ -109,28 +249,26 @@ async def transcribe(pcm_bytes: bytes) -> dict[str, any]:
             "code": int|None   # 错误码（2001=asr_failed）
         }
     """
-    if _model is None:
+    if _model is None or _executor is None:
         return {"text": "", "error": "asr_unavailable", "code": 2001}
 
     if not pcm_bytes:
         return {"text": "", "error": None, "code": None}
 
-    # 转换为 numpy array
+    # 零拷贝视图；唯一的真实拷贝是推理线程内的 int16 → float32 转换
     wave = np.frombuffer(pcm_bytes, dtype=np.int16)
 
     # VAD: 能量过滤
     if _compute_energy(wave) < ENERGY_THRESHOLD:
         return {"text": "", "error": None, "code": None}
 
-    # 归一化到 [-1, 1]
-    audio = wave.astype(np.float32) / 32768.0
-
     # 异步推理（在线程池中执行，避免阻塞事件循环）
     try:
-        text = await asyncio.wait_for(
-            asyncio.get_event_loop().run_in_executor(_executor, _do_transcribe_sync, audio),
-            timeout=ASR_TIMEOUT
-        )
+        if on_partial is None:
+            work = asyncio.get_running_loop().run_in_executor(_executor, _do_transcribe_sync, wave)
+        else:
+            work = _stream_transcribe(wave, on_partial)
+        text = await asyncio.wait_for(work, timeout=ASR_TIMEOUT)
         return {"text": text, "error": None, "code": None}
     except asyncio.TimeoutError:
         logger.warning("ASR timeout")
@@ -140,6 +278,33 @@ async def transcribe(pcm_bytes: bytes) -> dict[str, any]:
         return {"text": "", "error": f"asr_failed: {exc}", "code": 2001}
 
 
+def _norm_word(word: str) -> str:
+    return word.strip(".,!?;:\"'").lower()
+
+
+def drop_overlap(prev_text: str, text: str, max_words: int = 8) -> str:
+    """
+    去掉 text 开头与 prev_text 结尾重复的单词（窗口重叠音频会被重复识别）
+
+    取最长的 “prev 后缀 == text 前缀” 单词序列（最多 max_words 个）并从 text 中剔除
+    """
+    if not prev_text or not text:
+        return text
+    prev_words = [_norm_word(w) for w in prev_text.split()[-max_words:]]
+    words = text.split()
+    norm = [_norm_word(w) for w in words[:max_words]]
+    for k in range(min(len(prev_words), len(norm)), 0, -1):
+        if prev_words[-k:] == norm[:k]:
+            return " ".join(words[k:])
+    return text
+
+
 def init_asr() -> None:
     """初始化 ASR 模块（应用启动时调用）"""
     _load_model()
+
+    # 预热 JIT：用与热路径相同的类型（frombuffer 得到的只读 int16 数组，连续与抽取两种布局）触发编译
+    if _HAS_NUMBA:
+        warm = np.frombuffer(bytes(2 * QUICK_GATE_STRIDE), dtype=np.int16)
+        _rms_int16(warm)
+        _rms_int16(warm[::QUICK_GATE_STRIDE])
@@ -3,22 +3,75 @@
 
 提供：
 - login(): 用户名密码登录，返回Token
-- verify_token(): 校验Token，返回用户信息
+- verify_token(): 校验Token，返回用户信息（带短TTL进程内缓存）
 """
 from __future__ import annotations
 
+import hashlib
 import logging
+import os
 import secrets
+import time
+from collections import OrderedDict
 from typing import Any
 
+import anyio
 import bcrypt
 import psycopg
 from psycopg import AsyncConnection
 
-from echo.db import get_conn
+from echo.db import get_conn, get_ro_conn
 
 logger = logging.getLogger(__name__)
 
+# Token 校验缓存：blake2b(token) → (过期时间, 用户信息 | None)
+# 键用 16 字节摘要：条目内存固定，内存中也不保留明文Token
+# 登出立即失效；禁用用户/重新登录顶掉的旧Token最多再存活一个TTL
+TOKEN_CACHE_TTL = float(os.getenv("TOKEN_CACHE_TTL", "15"))
+TOKEN_CACHE_NEGATIVE_TTL = min(TOKEN_CACHE_TTL, 2.0)
+TOKEN_CACHE_SIZE = 8192
+_token_cache: OrderedDict[bytes, tuple[float, dict[str, Any] | None]] = OrderedDict()
+# 失效计数：每次 invalidate_token 加一。verify_token 查库前记下，写缓存时若已变化则不写，
+# 避免查询期间发生的登出被随后写入的旧结果覆盖
+_invalidations = 0
+
+
+def _cache_key(token: str) -> bytes:
+    return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+
+def _cache_get(token: str) -> tuple[bool, dict[str, Any] | None]:
+    """查缓存，返回 (是否命中, 用户信息)"""
+    key = _cache_key(token)
+    entry = _token_cache.get(key)
+    if entry is None:
+        return False, None
+    expires_at, user_info = entry
+    if expires_at < time.monotonic():
+        _token_cache.pop(key, None)
+        return False, None
+    _token_cache.move_to_end(key)
+    return True, user_info
+
+
+def _cache_put(token: str, user_info: dict[str, Any] | None, epoch: int) -> None:
+    """写缓存（LRU淘汰）；无效Token用更短的TTL；epoch 为查库前的失效计数，其间有Token失效则不写"""
+    ttl = TOKEN_CACHE_TTL if user_info else TOKEN_CACHE_NEGATIVE_TTL
+    if ttl <= 0 or epoch != _invalidations:
+        return
+    key = _cache_key(token)
+    _token_cache[key] = (time.monotonic() + ttl, user_info)
+    _token_cache.move_to_end(key)
+    while len(_token_cache) > TOKEN_CACHE_SIZE:
+        _token_cache.popitem(last=False)
+
+
+def invalidate_token(token: str) -> None:
+    """使缓存中的Token立即失效（进行中的 verify_token 也不会再把它写回缓存）"""
+    global _invalidations
+    _invalidations += 1
+    _token_cache.pop(_cache_key(token), None)
+
 
 async def login(username: str, password: str) -> dict[str, Any] | None:
     """
@@ -34,47 +87,56 @@ async def login(username: str, password: str) -> dict[str, Any] | None:
     fake_hash = "$2b$12$LQv3c1yqBWVHxkd0LHAkCOYz6TtxMQJqhN8/LewY5sDovXxP0CuKa"
 
     try:
-        async for conn in get_conn():
-            # 查询用户
+        # 先读出hash就归还连接：bcrypt 期间不占用连接池连接，也不持有行锁
+        async with get_ro_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
-                    SELECT id, username, password_hash, role, disabled_at
+                    SELECT id, password_hash
                     FROM users
-                    WHERE username = %s
+                    WHERE username = %s AND disabled_at IS NULL
                     """,
                     (username,),
                 )
                 row = await cur.fetchone()
 
-            # 始终执行bcrypt校验，防时序攻击
-            password_hash = row[2] if row else fake_hash
-            if not bcrypt.checkpw(password.encode(), password_hash.encode()):
-                return None
-
-            # 用户不存在或已禁用
-            if not row or row[4] is not None:
-                return None
-
-            user_id, username, _, role, _ = row
-
-            # 生成新Token（32字节随机串，hex编码）
-            token = secrets.token_hex(32)
-
-            # 更新用户Token
+        # 始终执行bcrypt校验，防时序攻击（用户不存在或已禁用时对假hash校验）
+        # bcrypt 是纯 CPU 计算（cost=12 约 250ms），放到线程池执行，避免阻塞事件循环
+        password_hash = row[1] if row else fake_hash
+        matched = await anyio.to_thread.run_sync(
+            bcrypt.checkpw, password.encode(), password_hash.encode()
+        )
+        if not matched or not row:
+            return None
+
+        # 生成新Token（32字节随机串，url-safe base64 编码，43字符）
+        token = secrets.token_urlsafe(32)
+
+        # 单条 UPDATE 走 autocommit 连接，执行即提交，不再多一次 COMMIT 往返
+        async with get_ro_conn() as conn:
+            # 带上校验过的hash：校验期间密码被修改或账号被禁用则不签发Token
             async with conn.cursor() as cur:
                 await cur.execute(
-                    "UPDATE users SET token = %s WHERE id = %s",
-                    (token, user_id),
+                    """
+                    UPDATE users
+                    SET token = %s
+                    WHERE id = %s AND password_hash = %s AND disabled_at IS NULL
+                    RETURNING id, username, role
+                    """,
+                    (token, row[0], password_hash),
                 )
-                await conn.commit()
-
-            return {
-                "user_id": user_id,
-                "username": username,
-                "role": role,
-                "token": token,
-            }
+                updated = await cur.fetchone()
+
+        if not updated:
+            return None
+
+        user_id, username, role = updated
+        return {
+            "user_id": user_id,
+            "username": username,
+            "role": role,
+            "token": token,
+        }
     except psycopg.Error as exc:
         logger.error(f"DB error during login for {username}: {exc}", exc_info=True)
         raise RuntimeError("Failed to login") from exc
@@ -90,8 +152,13 @@ async def verify_token(token: str) -> dict[str, Any] | None:
     Raises:
         RuntimeError: 数据库操作失败
     """
+    hit, user_info = _cache_get(token)
+    if hit:
+        return user_info
+    epoch = _invalidations
+
     try:
-        async for conn in get_conn():
+        async with get_ro_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -104,14 +171,17 @@ async def verify_token(token: str) -> dict[str, Any] | None:
                 row = await cur.fetchone()
 
             if not row:
+                _cache_put(token, None, epoch)
                 return None
 
             user_id, username, role = row
-            return {
+            user_info = {
                 "user_id": user_id,
                 "username": username,
                 "role": role,
             }
+            _cache_put(token, user_info, epoch)
+            return user_info
     except psycopg.Error as exc:
         logger.error(f"DB error verifying token: {exc}", exc_info=True)
         raise RuntimeError("Failed to verify token") from exc
@@ -126,15 +196,19 @@ async def logout(token: str) -> bool:
     Raises:
         RuntimeError: 数据库操作失败
     """
+    invalidate_token(token)
+
     try:
-        async for conn in get_conn():
+        async with get_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     "UPDATE users SET token = NULL WHERE token = %s",
                     (token,),
                 )
                 await conn.commit()
-                return cur.rowcount > 0
+        # 提交后再失效一次：提交前已读到旧记录的 verify_token 可能刚把它写回缓存
+        invalidate_token(token)
+        return cur.rowcount > 0
     except psycopg.Error as exc:
         logger.error(f"DB error during logout: {exc}", exc_info=True)
         raise RuntimeError("Failed to logout") from exc
@@ -3,14 +3,18 @@
 
 提供：
 - get_pool(): 获取全局连接池（psycopg3 async pool）
+- get_ro_pool(): autocommit 连接池（纯 SELECT 与无需事务的单条写语句用）
+- open_pool(): 启动时预建连接，并定期检查连接池是否饱和
 - init_db(): 执行schema.sql初始化表结构
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 import os
+from contextlib import AbstractAsyncContextManager
+from functools import lru_cache
 from pathlib import Path
-from typing import AsyncGenerator
 
 import psycopg
 from psycopg import AsyncConnection
@@ -19,38 +23,124 @@ from psycopg_pool import AsyncConnectionPool
 logger = logging.getLogger(__name__)
 
 
+# 每个进程的连接预算（读写池与 autocommit 池合计）：默认 min=4、max=2×CPU+1
+# （连接数超过 CPU 能并行处理的量后只会加剧争用）
+POOL_MIN_SIZE = int(os.environ.get("DB_POOL_MIN_SIZE", "4"))
+POOL_MAX_SIZE = max(POOL_MIN_SIZE, int(os.environ.get("DB_POOL_MAX_SIZE", str(2 * (os.cpu_count() or 1) + 1))))
+# 读写池中常驻后台任务占用的连接数（字幕批量 writer 刷盘时占一个），读写池至少再给请求留一个
+RW_RESERVED_CONNECTIONS = 1
+# 两个池各分一半预算（读写池拿余数）
+RO_POOL_MAX_SIZE = max(1, POOL_MAX_SIZE // 2)
+RW_POOL_MAX_SIZE = max(RW_RESERVED_CONNECTIONS + 1, POOL_MAX_SIZE - RO_POOL_MAX_SIZE)
+RO_POOL_MIN_SIZE = min(POOL_MIN_SIZE // 2, RO_POOL_MAX_SIZE)
+RW_POOL_MIN_SIZE = min(POOL_MIN_SIZE - POOL_MIN_SIZE // 2, RW_POOL_MAX_SIZE)
+# 同一条 SQL 在一个连接上执行满这么多次后才服务端 prepare：热点查询很快达到，
+# 只执行一两次的语句（如 init_db 的 schema）不会白白占用服务端 prepared statement
+PREPARE_THRESHOLD = 5
+# 饱和检查间隔（秒）
+POOL_STATS_INTERVAL = 60.0
+
 _pool: AsyncConnectionPool | None = None
 
+# autocommit 连接池：纯 SELECT 与单条写语句不需要 BEGIN/COMMIT 包裹，省掉两条协议消息和 COMMIT 往返
+# （名字沿用 ro：绝大多数调用方是只读查询；需要多条语句同一事务的写操作仍走 get_conn）
+_ro_pool: AsyncConnectionPool | None = None
+
+
+def _create_pool(min_size: int, max_size: int, autocommit: bool = False) -> AsyncConnectionPool:
+    database_url = os.environ.get("DATABASE_URL")
+    if not database_url:
+        raise RuntimeError("DATABASE_URL environment variable not set")
+    return AsyncConnectionPool(
+        conninfo=database_url,
+        min_size=min_size,
+        max_size=max_size,
+        timeout=30.0,
+        max_idle=300.0,
+        max_lifetime=3600.0,
+        kwargs={"prepare_threshold": PREPARE_THRESHOLD, "autocommit": autocommit},
+    )
+
 
 def get_pool() -> AsyncConnectionPool:
-    """获取全局连接池，首次调用时创建"""
+    """获取全局连接池（读写），首次调用时创建"""
     global _pool
     if _pool is None:
-        database_url = os.environ.get("DATABASE_URL")
-        if not database_url:
-            raise RuntimeError("DATABASE_URL environment variable not set")
-        _pool = AsyncConnectionPool(
-            conninfo=database_url,
-            min_size=2,
-            max_size=10,
-            timeout=30.0,
-        )
+        _pool = _create_pool(RW_POOL_MIN_SIZE, RW_POOL_MAX_SIZE)
     return _pool
 
 
+def get_ro_pool() -> AsyncConnectionPool:
+    """获取 autocommit 连接池，首次调用时创建"""
+    global _ro_pool
+    if _ro_pool is None:
+        _ro_pool = _create_pool(RO_POOL_MIN_SIZE, RO_POOL_MAX_SIZE, autocommit=True)
+    return _ro_pool
+
+
+# 连接池饱和检查任务
+_monitor: asyncio.Task | None = None
+
+
+async def _monitor_pools(interval: float) -> None:
+    """定期取出连接池统计（pop_stats 会清零计数器），出现排队等待连接时告警"""
+    while True:
+        await asyncio.sleep(interval)
+        for name, pool in (("rw", _pool), ("ro", _ro_pool)):
+            if pool is None:
+                continue
+            stats = pool.pop_stats()
+            queued = stats.get("requests_queued", 0)
+            if queued or stats.get("requests_errors", 0):
+                logger.warning(f"DB pool {name} saturated: {stats}")
+            else:
+                logger.debug(f"DB pool {name} stats: {stats}")
+
+
+async def open_pool(timeout: float = 30.0) -> None:
+    """打开连接池并等待 min_size 个物理连接建立（避免首个请求承担建连/认证开销）"""
+    global _monitor
+    await get_pool().open(wait=True, timeout=timeout)
+    await get_ro_pool().open(wait=True, timeout=timeout)
+    if _monitor is None:
+        _monitor = asyncio.create_task(_monitor_pools(POOL_STATS_INTERVAL))
+
+
 async def close_pool() -> None:
     """关闭连接池（用于优雅退出）"""
-    global _pool
+    global _pool, _ro_pool, _monitor
+    if _monitor is not None:
+        _monitor.cancel()
+        _monitor = None
     if _pool is not None:
         await _pool.close()
         _pool = None
+    if _ro_pool is not None:
+        await _ro_pool.close()
+        _ro_pool = None
 
 
-async def get_conn() -> AsyncGenerator[AsyncConnection, None]:
-    """获取数据库连接（上下文管理器）"""
-    pool = get_pool()
-    async with pool.connection() as conn:
-        yield conn
+def get_conn() -> AbstractAsyncContextManager[AsyncConnection]:
+    """
+    获取数据库连接（上下文管理器）：async with get_conn() as conn
+
+    直接返回连接池的上下文管理器，不再包一层 async generator
+    """
+    return get_pool().connection()
+
+
+def get_ro_conn() -> AbstractAsyncContextManager[AsyncConnection]:
+    """获取 autocommit 连接（纯 SELECT 或单条写语句，语句执行完即提交）：async with get_ro_conn() as conn"""
+    return get_ro_pool().connection()
+
+
+@lru_cache(maxsize=1)
+def _load_schema() -> str:
+    """读取 schema.sql（进程内只读一次）"""
+    schema_path = Path(__file__).parent.parent / "schema.sql"
+    if not schema_path.exists():
+        raise FileNotFoundError(f"schema.sql not found at {schema_path}")
+    return schema_path.read_text(encoding="utf-8")
 
 
 async def init_db() -> None:
@@ -61,15 +151,12 @@ async def init_db() -> None:
         FileNotFoundError: schema.sql 文件不存在
         RuntimeError: 数据库初始化失败
     """
-    schema_path = Path(__file__).parent.parent / "schema.sql"
-    if not schema_path.exists():
-        raise FileNotFoundError(f"schema.sql not found at {schema_path}")
-
-    sql = schema_path.read_text(encoding="utf-8")
+    sql = _load_schema()
 
     try:
         async with get_pool().connection() as conn:
-            await conn.execute(sql)
+            # 多语句不能服务端 prepare：显式 prepare=False，无参数时才走 simple query 协议，整份 schema 一次往返
+            await conn.execute(sql, prepare=False)
             await conn.commit()
             logger.info("Database initialized successfully")
     except psycopg.Error as exc:
@@ -8,7 +8,7 @@ from typing import Any
 
 import psycopg
 
-from echo.db import get_conn
+from echo.db import get_conn, get_ro_conn
 
 logger = logging.getLogger(__name__)
 
@@ -23,7 +23,7 @@ async def create_lecture(title: str, creator_id: int) -> dict[str, Any]:
         RuntimeError: 数据库操作失败
     """
     try:
-        async for conn in get_conn():
+        async with get_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -49,25 +49,25 @@ async def create_lecture(title: str, creator_id: int) -> dict[str, Any]:
         raise RuntimeError("Failed to create lecture") from exc
 
 
-async def get_lecture(lecture_id: int) -> dict[str, Any] | None:
+async def get_lecture_for_owner(lecture_id: int, creator_id: int) -> dict[str, Any] | None:
     """
-    获取讲座详情
+    获取讲座详情（仅创建者），存在性与归属检查合并为一次查询
 
-    返回讲座信息或None（不存在或已软删除）
+    返回讲座信息或None（不存在、已软删除或非创建者，调用方统一按404处理）
 
     Raises:
         RuntimeError: 数据库操作失败
     """
     try:
-        async for conn in get_conn():
+        async with get_ro_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
                     SELECT id, title, creator_id, status, created_at, ended_at
                     FROM lectures
-                    WHERE id = %s AND deleted_at IS NULL
+                    WHERE id = %s AND creator_id = %s AND deleted_at IS NULL
                     """,
-                    (lecture_id,),
+                    (lecture_id, creator_id),
                 )
                 row = await cur.fetchone()
 
@@ -97,7 +97,7 @@ async def list_lectures(user_id: int, limit: int = 50, offset: int = 0) -> list[
         RuntimeError: 数据库操作失败
     """
     try:
-        async for conn in get_conn():
+        async with get_ro_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -137,7 +137,7 @@ async def update_lecture_status(lecture_id: int, status: str) -> bool:
         RuntimeError: 数据库操作失败
     """
     try:
-        async for conn in get_conn():
+        async with get_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
@@ -154,28 +154,41 @@ async def update_lecture_status(lecture_id: int, status: str) -> bool:
         raise RuntimeError("Failed to update lecture status") from exc
 
 
-async def end_lecture(lecture_id: int) -> bool:
+async def end_lecture_authz(lecture_id: int, creator_id: int) -> dict[str, Any] | None:
     """
-    结束讲座（设置ended_at，状态改为summarizing）
+    结束讲座（仅创建者），鉴权与更新合并为一次往返
 
-    返回True（成功）或False（讲座不存在）
+    返回更新后的讲座信息，或None（不存在、已软删除或非创建者，调用方统一按404处理）
 
     Raises:
         RuntimeError: 数据库操作失败
     """
     try:
-        async for conn in get_conn():
+        async with get_conn() as conn:
             async with conn.cursor() as cur:
                 await cur.execute(
                     """
                     UPDATE lectures
                     SET status = 'summarizing', ended_at = NOW()
-                    WHERE id = %s AND deleted_at IS NULL
+                    WHERE id = %s AND creator_id = %s AND deleted_at IS NULL
+                    RETURNING id, title, creator_id, status, created_at, ended_at
                     """,
-                    (lecture_id,),
+                    (lecture_id, creator_id),
                 )
+                row = await cur.fetchone()
                 await conn.commit()
-                return cur.rowcount > 0
+
+            if not row:
+                return None
+
+            return {
+                "id": row[0],
+                "title": row[1],
+                "creator_id": row[2],
+                "status": row[3],
+                "created_at": row[4],
+                "ended_at": row[5],
+            }
     except psycopg.Error as exc:
         logger.error(f"DB error ending lecture {lecture_id}: {exc}", exc_info=True)
         raise RuntimeError("Failed to end lecture") from exc
@@ -3,8 +3,9 @@ from __future__ import annotations
 import asyncio
 import logging
 import os
+import time
 from pathlib import Path
-from typing import Any
+from types import ModuleType
 
 logger = logging.getLogger(__name__)
 
@@ -18,15 +19,48 @@ except ImportError:
 
 from fastapi import FastAPI, Header, HTTPException, Request, WebSocket, WebSocketDisconnect, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, StreamingResponse
 
 from echo.auth import login, logout
-from echo.db import close_pool, get_pool
-from echo.lectures import create_lecture, end_lecture, get_lecture, list_lectures
+from echo.db import close_pool, get_pool, open_pool
+from echo.lectures import create_lecture, end_lecture_authz, get_lecture_for_owner, list_lectures
 from echo.middleware import AuthMiddleware
 from echo.models import CreateLectureRequest, LectureInfo, LoginRequest, TokenResponse
+from echo.storage import init_storage
+from echo.translate import close_client, translate_text
+from echo.utterances import enqueue_translation, enqueue_utterance, list_utterances, start_writer, stop_writer
+from echo.ws import (
+    authenticate_ws,
+    broadcast,
+    broadcast_partial,
+    broadcast_translation_patch,
+    discard_partial,
+    encode_message,
+    init_seq_counter,
+    join_room,
+    leave_room,
+    next_seq,
+    send_to,
+    stop_heartbeat,
+    stream_backfill,
+)
+
+
+app = FastAPI(title="Echo Backend", version="0.1.0", default_response_class=ORJSONResponse)
 
+# echo.asr 导入时即加载 faster_whisper/torch 与 Numba VAD 模块，较重：不在模块顶层导入，
+# 由 startup 导入一次并绑定到这里，请求路径上直接取属性
+asr: ModuleType | None = None
 
-app = FastAPI(title="Echo Backend", version="0.1.0")
+# 每个 WebSocket 连接待推理的音频窗口上限（约 ASR_QUEUE_SIZE × 窗口时长的积压）
+ASR_QUEUE_SIZE = 4
+# 连接断开后等待剩余音频推理完成的最长时间（秒），超时后放弃剩余窗口
+ASR_DRAIN_TIMEOUT = 30.0
+
+# 进行中的翻译任务：直接作为独立任务运行（而非排队给 2 个 worker），
+# 这样并发的翻译请求能在 translate 的合并窗口内凑成一批；超过上限时丢弃新任务
+TRANSLATE_MAX_INFLIGHT = 256
+_translations: set[asyncio.Task] = set()
 
 # CORS 配置（开发环境）
 app.add_middleware(
@@ -43,23 +77,23 @@ app.add_middleware(AuthMiddleware)
 
 @app.on_event("startup")
 async def startup() -> None:
-    """应用启动时初始化连接池、任务队列、存储目录和 ASR"""
-    from echo.asr import init_asr
-    from echo.storage import init_storage
-    from echo.tasks import start_workers
+    """应用启动时初始化连接池、字幕 writer、存储目录和 ASR"""
+    global asr
+    import echo.asr as asr
 
-    get_pool()  # 触发连接池创建
-    start_workers(num_workers=2)  # 启动2个worker
+    await open_pool()  # 创建连接池并预建连接
+    start_writer(get_pool())  # 启动字幕批量落库 writer
     init_storage()  # 初始化存储目录
-    init_asr()  # 初始化 Whisper 模型
+    asr.init_asr()  # 初始化 Whisper 模型
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
-    """应用关闭时清理连接池和任务队列"""
-    from echo.tasks import stop_workers
-
-    await stop_workers()
+    """应用关闭时等待翻译任务、写完剩余字幕，再关闭 HTTP 客户端和连接池"""
+    stop_heartbeat()
+    await _stop_translations()
+    await stop_writer(get_pool())
+    await close_client()
     await close_pool()
 
 
@@ -77,7 +111,7 @@ async def api_login(req: LoginRequest) -> TokenResponse:
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid username or password",
         )
-    return TokenResponse(**result)
+    return TokenResponse.model_construct(**result)
 
 
 @app.post("/api/auth/logout")
@@ -109,80 +143,59 @@ async def api_create_lecture(req: CreateLectureRequest, request: Request) -> Lec
     """创建讲座"""
     user = request.state.user
     result = await create_lecture(req.title, user["user_id"])
-    return LectureInfo(**result)
+    return LectureInfo.model_construct(**result)
 
 
 @app.get("/api/lectures", response_model=list[LectureInfo])
-async def api_list_lectures(request: Request, limit: int = 50, offset: int = 0) -> list[LectureInfo]:
-    """列出当前用户创建的讲座"""
+async def api_list_lectures(request: Request, limit: int = 50, offset: int = 0) -> ORJSONResponse:
+    """
+    列出当前用户创建的讲座
+
+    list_lectures 的 dict 直接交给 orjson 序列化，不逐行构造模型、也不走 jsonable_encoder；
+    response_model 仅用于 OpenAPI 文档
+    """
     user = request.state.user
     results = await list_lectures(user["user_id"], limit, offset)
-    return [LectureInfo(**r) for r in results]
+    return ORJSONResponse(results)
 
 
 @app.get("/api/lectures/{lecture_id}", response_model=LectureInfo)
 async def api_get_lecture(lecture_id: int, request: Request) -> LectureInfo:
     """获取讲座详情（仅创建者可见）"""
-    result = await get_lecture(lecture_id)
+    # 仅创建者可见：鉴权下推到 SQL，不存在与非创建者统一返回404
+    user = request.state.user
+    result = await get_lecture_for_owner(lecture_id, user["user_id"])
     if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Lecture not found",
         )
 
-    # 权限检查：仅创建者可见
-    user = request.state.user
-    if result["creator_id"] != user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied",
-        )
-
-    return LectureInfo(**result)
+    return LectureInfo.model_construct(**result)
 
 
 @app.post("/api/lectures/{lecture_id}/join")
 async def api_join_lecture(lecture_id: int, request: Request) -> LectureInfo:
     """加入讲座（仅创建者可加入，后续可扩展为多用户共享）"""
-    result = await get_lecture(lecture_id)
+    # 仅创建者可加入（后续可改为允许邀请用户）：鉴权下推到 SQL，不存在与非创建者统一返回404
+    user = request.state.user
+    result = await get_lecture_for_owner(lecture_id, user["user_id"])
     if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Lecture not found",
         )
 
-    # 权限检查：仅创建者可加入（后续可改为允许邀请用户）
-    user = request.state.user
-    if result["creator_id"] != user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied",
-        )
-
-    return LectureInfo(**result)
+    return LectureInfo.model_construct(**result)
 
 
 @app.post("/api/lectures/{lecture_id}/end")
 async def api_end_lecture(lecture_id: int, request: Request) -> dict[str, str]:
     """结束讲座（仅创建者可操作）"""
-    # 先获取讲座检查权限
-    result = await get_lecture(lecture_id)
-    if not result:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="Lecture not found",
-        )
-
-    # 权限检查：仅创建者可结束
+    # 鉴权下推到 SQL：不存在与非创建者统一返回404，不泄露讲座是否存在
     user = request.state.user
-    if result["creator_id"] != user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied",
-        )
-
-    success = await end_lecture(lecture_id)
-    if not success:
+    result = await end_lecture_authz(lecture_id, user["user_id"])
+    if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Lecture not found",
@@ -196,44 +209,178 @@ async def api_get_utterances(
     request: Request,
     source: str = "realtime",
     limit: int = 1000,
-    offset: int = 0
-) -> list[dict[str, Any]]:
-    """获取讲座的历史字幕列表（仅创建者可见）"""
-    from echo.utterances import list_utterances
-
-    # 检查讲座是否存在
-    result = await get_lecture(lecture_id)
+    offset: int = 0,
+    after_seq: int | None = None
+) -> StreamingResponse:
+    """获取讲座的历史字幕列表（仅创建者可见；翻页可传 after_seq=上一页最后的 seq 代替 offset）"""
+    # 仅创建者可见：鉴权下推到 SQL，不存在与非创建者统一返回404
+    user = request.state.user
+    result = await get_lecture_for_owner(lecture_id, user["user_id"])
     if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail="Lecture not found",
         )
 
-    # 权限检查：仅创建者可见
-    user = request.state.user
-    if result["creator_id"] != user["user_id"]:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail="Access denied",
-        )
-
     # 查询字幕列表
     pool = get_pool()
-    utterances = await list_utterances(pool, lecture_id, source, limit, offset)
-
-    # 转换为与 WebSocket 消息一致的格式
-    return [
-        {
-            "type": "subtitle",
-            "lecture_id": lecture_id,
-            "seq": u["seq"],
-            "start_ms": u["start_ms"],
-            "end_ms": u["end_ms"],
-            "text_en": u["text_en"],
-            "text_zh": u["text_zh"],
-        }
-        for u in utterances
-    ]
+    utterances = await list_utterances(pool, lecture_id, source, limit, offset, after_seq)
+
+    # 转换为与 WebSocket 消息一致的格式，分块序列化输出
+    return StreamingResponse(stream_backfill(lecture_id, utterances), media_type="application/json")
+
+
+async def _translate_and_broadcast(lecture_id: int, seq: int, text_en: str) -> None:
+    """异步翻译任务：翻译 → 广播补丁 → 更新数据库"""
+    # 调用翻译 API
+    translate_result = await translate_text(text_en)
+    text_zh = translate_result.get("text", "")
+
+    # 翻译失败，仅记录日志
+    if translate_result.get("code") == 3001:
+        logger.warning(f"Translation failed for seq {seq}: {translate_result.get('error')}")
+        return
+
+    # 翻译成功，广播中文补丁
+    if text_zh:
+        await broadcast_translation_patch(lecture_id, seq, text_zh)
+
+        # 更新数据库
+        enqueue_translation(lecture_id, seq, text_zh, source="realtime")
+
+
+def _on_translation_done(task: asyncio.Task) -> None:
+    _translations.discard(task)
+    if not task.cancelled() and task.exception() is not None:
+        logger.error(f"Translation task failed: {task.exception()}", exc_info=task.exception())
+
+
+def _start_translation(lecture_id: int, seq: int, text_en: str) -> None:
+    """启动翻译任务（不阻塞）"""
+    if len(_translations) >= TRANSLATE_MAX_INFLIGHT:
+        logger.warning(f"Too many pending translations, dropped seq {seq} of lecture {lecture_id}")
+        return
+    task = asyncio.create_task(_translate_and_broadcast(lecture_id, seq, text_en))
+    _translations.add(task)
+    task.add_done_callback(_on_translation_done)
+
+
+async def _stop_translations(timeout: float = 5.0) -> None:
+    """等待进行中的翻译完成（带超时），超时后取消"""
+    if not _translations:
+        return
+    _, pending = await asyncio.wait(set(_translations), timeout=timeout)
+    for task in pending:
+        task.cancel()
+
+
+async def _asr_loop(
+    websocket: WebSocket,
+    lecture_id: int,
+    windows: asyncio.Queue[tuple[bytes, int, int] | None],
+) -> None:
+    """
+    ASR 消费者：从窗口队列取音频 → 转录 → 广播字幕 → 落库/翻译
+
+    与接收循环解耦，推理期间接收端继续读取 TCP 缓冲。
+    推理跟不上时队列里会积压多个窗口，此时合并为一次 Whisper 调用（去掉后续窗口的重叠部分）
+
+    windows 元素：(窗口音频, 开头属于上一窗口重叠部分的字节数, 窗口末尾在整条音频流中的字节偏移)
+    时间戳由字节偏移直接换算，不逐窗累加，静音窗口与被丢弃的窗口也不会造成漂移；
+    取到 None 表示连接已断开，处理完之前入队的窗口后退出
+    """
+    prev_text = ""
+    held: tuple[bytes, int, int] | None = None  # 上一轮合并时放不下、留到本轮的窗口
+    stopping = False
+
+    while True:
+        if held is not None:
+            window, held = held, None
+        elif stopping:
+            return
+        else:
+            window = await windows.get()
+            if window is None:
+                return
+        frame, overlap, end_offset = window
+        new_bytes = len(frame) - overlap
+
+        # 积压时合并后续窗口（合并后不超过 MAX_MERGE_BYTES，保证能在推理超时内完成；放不下的留给下一轮）
+        if not windows.empty():
+            parts = [frame]
+            size = len(frame)
+            while not windows.empty():
+                window = windows.get_nowait()
+                if window is None:
+                    stopping = True
+                    break
+                nxt, nxt_overlap, _ = window
+                if size + len(nxt) - nxt_overlap > asr.MAX_MERGE_BYTES:
+                    held = window
+                    break
+                end_offset = window[2]
+                parts.append(nxt[nxt_overlap:])
+                size += len(nxt) - nxt_overlap
+                new_bytes += len(nxt) - nxt_overlap
+            frame = b"".join(parts)
+
+        try:
+            # ASR 转录（逐段推送 subtitle_partial，短时间内的多条合并发送；解码完成后再发最终字幕）
+            async def _broadcast_partial(text: str) -> None:
+                text = asr.drop_overlap(prev_text, text)
+                if text:
+                    broadcast_partial(lecture_id, {
+                        "type": "subtitle_partial",
+                        "lecture_id": lecture_id,
+                        "text_en": text,
+                    })
+
+            result = await asr.transcribe(frame, on_partial=_broadcast_partial)
+            discard_partial(lecture_id)
+
+            # 处理错误
+            if result.get("code") == 2001:
+                await send_to(websocket, {
+                    "type": "error",
+                    "code": 2001,
+                    "message": result.get("error", "ASR failed")
+                })
+                continue
+
+            # 静音/无内容，跳过
+            full_text = result.get("text", "")
+            text_en = asr.drop_overlap(prev_text, full_text)
+            prev_text = full_text
+            if not text_en:
+                continue
+
+            # 生成 seq
+            seq = next_seq(lecture_id)
+
+            # 计算时间戳（本次新增音频在流中的区间，不含重叠部分）
+            start_ms = (end_offset - new_bytes) // asr.BYTES_PER_MS
+            end_ms = end_offset // asr.BYTES_PER_MS
+
+            # 立即广播英文字幕（不等待翻译）；序列化一次，房间内所有连接共享同一段文本（无人收听时不序列化）
+            subtitle_msg = {
+                "type": "subtitle",
+                "lecture_id": lecture_id,
+                "seq": seq,
+                "start_ms": start_ms,
+                "end_ms": end_ms,
+                "text_en": text_en,
+            }
+            await broadcast(lecture_id, lambda: encode_message(subtitle_msg))
+
+            # 异步提交翻译任务（不阻塞）：broadcast 只入队即返回，翻译请求与字幕发送并发；
+            # 同一连接的发送队列保证中文补丁在英文字幕之后送达（前端会丢弃未知 seq 的补丁）
+            _start_translation(lecture_id, seq, text_en)
+
+            # 异步落库英文字幕（text_zh=""）；队列满时丢弃（字幕已广播），由队列侧计数告警
+            enqueue_utterance(lecture_id, seq, start_ms, end_ms, text_en, "", source="realtime")
+        except Exception as exc:
+            # 单个窗口失败不影响后续窗口
+            logger.error(f"ASR loop error for lecture {lecture_id}: {exc}", exc_info=True)
 
 
 @app.websocket("/ws/lectures/{lecture_id}")
@@ -245,14 +392,11 @@ async def lecture_socket(websocket: WebSocket, lecture_id: int) -> None:
     心跳：服务端每30s发ping，客户端应回pong
     消息格式：
       - 入站：二进制PCM帧（16kHz mono int16）或文本"pong"
-      - 出站：{type:'info'|'subtitle'|'error'|'ping', ...}
-    """
-    from echo.asr import transcribe
-    from echo.tasks import submit_task
-    from echo.translate import translate_text
-    from echo.utterances import create_utterance
-    from echo.ws import authenticate_ws, broadcast, heartbeat, init_seq_counter, join_room, leave_room, next_seq
+      - 出站：{type:'info'|'subtitle_partial'|'subtitle'|'subtitle_zh'|'error'|'ping', ...}
+        subtitle_partial 为解码中的累计英文文本（无 seq），随后的 subtitle 为最终结果
 
+    接收循环只负责攒窗口并入队，ASR 在独立任务 _asr_loop 中执行
+    """
     await websocket.accept()
 
     # WS握手鉴权
@@ -261,33 +405,33 @@ async def lecture_socket(websocket: WebSocket, lecture_id: int) -> None:
         await websocket.close(code=1008, reason="Unauthorized: missing or invalid token")
         return
 
-    # 检查讲座是否存在
-    lecture = await get_lecture(lecture_id)
+    # 仅创建者可加入（M1暂不支持多用户）：不存在与非创建者统一按不存在处理
+    lecture = await get_lecture_for_owner(lecture_id, user_info["user_id"])
     if not lecture:
         await websocket.close(code=1008, reason="Lecture not found")
         return
 
-    # 权限检查：仅创建者可加入（M1暂不支持多用户）
-    if lecture["creator_id"] != user_info["user_id"]:
-        await websocket.close(code=1008, reason="Access denied")
-        return
-
     # 初始化 seq 计数器（从 DB 恢复）
     pool = get_pool()
     await init_seq_counter(lecture_id, pool)
 
-    # 加入房间
+    # 加入房间（由共享心跳任务定时发 ping）
     await join_room(lecture_id, websocket)
 
-    # 启动心跳任务
-    heartbeat_task = asyncio.create_task(heartbeat(websocket))
+    # 接收端 → ASR 的窗口队列（有界；满时丢最旧的窗口，优先保证字幕实时性）
+    windows: asyncio.Queue[tuple[bytes, int, int] | None] = asyncio.Queue(maxsize=ASR_QUEUE_SIZE)
+    asr_task = asyncio.create_task(_asr_loop(websocket, lecture_id, windows))
 
-    # 时间戳累加器（用于生成 start_ms/end_ms）
-    cumulative_ms = 0
+    # 音频窗口：客户端小帧攒够 WINDOW_BYTES 或距上次推理超过 FLUSH_INTERVAL 再送 Whisper
+    # 窗口开头保留上一窗口末尾 OVERLAP_BYTES 的音频，识别结果中的重复单词用 drop_overlap 去掉
+    audio_buf = bytearray()
+    carried = 0  # audio_buf 开头属于上一窗口重叠部分的字节数
+    received = 0  # 已收到的音频总字节数（时间戳基准）
+    last_flush = time.monotonic()
 
     try:
         # 发送欢迎消息
-        await websocket.send_json({
+        await send_to(websocket, {
             "type": "info",
             "message": f"Connected to lecture {lecture_id}",
             "user": user_info["username"],
@@ -305,76 +449,22 @@ async def lecture_socket(websocket: WebSocket, lecture_id: int) -> None:
 
             # 处理音频帧（二进制）
             if "bytes" in data:
-                frame = data["bytes"]
-
-                # ASR 转录
-                result = await transcribe(frame)
-
-                # 处理错误
-                if result.get("code") == 2001:
-                    await websocket.send_json({
-                        "type": "error",
-                        "code": 2001,
-                        "message": result.get("error", "ASR failed")
-                    })
+                audio_buf.extend(data["bytes"])
+                received += len(data["bytes"])
+                if len(audio_buf) < asr.WINDOW_BYTES and time.monotonic() - last_flush < asr.FLUSH_INTERVAL:
                     continue
 
-                # 静音/无内容，跳过
-                text_en = result.get("text", "")
-                if not text_en:
-                    continue
+                # 取出窗口（拷贝一份：推理超时后线程可能仍持有视图，bytearray 不能在导出期间改动）
+                frame = bytes(audio_buf)
+                overlap = carried
+                carried = min(asr.OVERLAP_BYTES, len(frame))
+                del audio_buf[:len(frame) - carried]
+                last_flush = time.monotonic()
 
-                # 生成 seq
-                seq = await next_seq(lecture_id)
-
-                # 计算时间戳（假设每帧 1s，实际应从音频长度计算）
-                frame_duration_ms = len(frame) // 32  # 16kHz mono int16 = 32 bytes/ms
-                start_ms = cumulative_ms
-                end_ms = cumulative_ms + frame_duration_ms
-                cumulative_ms = end_ms
-
-                # 立即广播英文字幕（不等待翻译）
-                subtitle_msg = {
-                    "type": "subtitle",
-                    "lecture_id": lecture_id,
-                    "seq": seq,
-                    "start_ms": start_ms,
-                    "end_ms": end_ms,
-                    "text_en": text_en,
-                }
-                await broadcast(lecture_id, subtitle_msg)
-
-                # 异步落库英文字幕（text_zh=""）
-                submit_task(create_utterance, pool, lecture_id, seq, start_ms, end_ms, text_en, "", source="realtime")
-
-                # 异步提交翻译任务（不阻塞）
-                async def _translate_and_broadcast(
-                    lecture_id: int,
-                    seq: int,
-                    text_en: str,
-                ) -> None:
-                    """异步翻译任务：翻译 → 广播补丁 → 更新数据库"""
-                    from echo.translate import translate_text
-                    from echo.utterances import update_translation
-                    from echo.ws import broadcast_translation_patch
-
-                    # 调用翻译 API
-                    translate_result = await translate_text(text_en)
-                    text_zh = translate_result.get("text", "")
-
-                    # 翻译失败，仅记录日志
-                    if translate_result.get("code") == 3001:
-                        logger.warning(f"Translation failed for seq {seq}: {translate_result.get('error')}")
-                        return
-
-                    # 翻译成功，广播中文补丁
-                    if text_zh:
-                        await broadcast_translation_patch(lecture_id, seq, text_zh)
-
-                        # 更新数据库
-                        await update_translation(pool, lecture_id, seq, text_zh, source="realtime")
-
-                submit_task(_translate_and_broadcast, lecture_id, seq, text_en)
+                if windows.full():
+                    windows.get_nowait()
+                    logger.warning(f"ASR backlog full for lecture {lecture_id}, dropped oldest window")
+                windows.put_nowait((frame, overlap, received))
 
     except WebSocketDisconnect:
         pass
@@ -385,9 +475,19 @@ async def lecture_socket(websocket: WebSocket, lecture_id: int) -> None:
         except Exception:
             pass  # 连接可能已关闭
     finally:
-        # 清理：离开房间，取消心跳
-        await leave_room(lecture_id, websocket)
-        heartbeat_task.cancel()
+        # 断开后先把不足一个窗口的剩余音频和已排队的窗口推理完（有时间上限），讲座结尾的字幕不丢；
+        # ASR 结束后再离开房间（同时停止心跳），不会在离开之后还取号/广播
+        try:
+            async with asyncio.timeout(ASR_DRAIN_TIMEOUT):
+                if len(audio_buf) > carried:
+                    await windows.put((bytes(audio_buf), carried, received))
+                await windows.put(None)
+                await asr_task
+        except TimeoutError:
+            logger.warning(f"ASR drain timed out for lecture {lecture_id}, dropping the remaining audio")
+        finally:
+            asr_task.cancel()
+            await leave_room(lecture_id, websocket)
 
 
 def create_app() -> FastAPI:
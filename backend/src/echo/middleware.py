@@ -3,11 +3,9 @@ FastAPI中间件：Bearer Token鉴权
 """
 from __future__ import annotations
 
-from typing import Callable
-
-from fastapi import Request, Response, status
+from fastapi import status
 from fastapi.responses import JSONResponse
-from starlette.middleware.base import BaseHTTPMiddleware
+from starlette.types import ASGIApp, Receive, Scope, Send
 
 from echo.auth import verify_token
 
@@ -21,46 +19,73 @@ EXCLUDE_PATHS = {
     "/redoc",
 }
 
+# 中间件内按原始 bytes 路径比较，省掉每个请求的 str 解码
+_EXCLUDE_BYTES = frozenset(p.encode() for p in EXCLUDE_PATHS)
+
+# 文档页的子路径（如 /docs/oauth2-redirect）按前缀放行，仅限文档路由自身
+_EXCLUDE_PREFIXES = (b"/docs/", b"/redoc/")
+
+
+def _unauthorized(detail: str) -> JSONResponse:
+    return JSONResponse(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        content={"error": "unauthorized", "detail": detail},
+    )
+
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    """Bearer Token鉴权中间件"""
+class AuthMiddleware:
+    """
+    Bearer Token鉴权中间件（纯 ASGI 实现）
+
+    不继承 BaseHTTPMiddleware：省掉每个请求的 Request 构造、call_next 后台任务和响应流转发
+    """
+
+    def __init__(self, app: ASGIApp) -> None:
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        # 仅处理 HTTP（WebSocket 在握手后自行鉴权）
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
 
-    async def dispatch(self, request: Request, call_next: Callable) -> Response:
         # 跳过 OPTIONS 请求（CORS 预检）
-        if request.method == "OPTIONS":
-            return await call_next(request)
+        if scope["method"] == "OPTIONS":
+            await self.app(scope, receive, send)
+            return
+
+        # 排除不需要鉴权的路径（精确匹配，避免前缀误放行；文档子路径除外）
+        raw_path = scope.get("raw_path") or scope["path"].encode()
+        if raw_path in _EXCLUDE_BYTES or raw_path.startswith(_EXCLUDE_PREFIXES):
+            await self.app(scope, receive, send)
+            return
 
-        # 排除不需要鉴权的路径（精确匹配，避免前缀误放行）
-        if request.url.path in EXCLUDE_PATHS:
-            return await call_next(request)
+        # 提取Authorization header（ASGI 头名已是小写 bytes）
+        auth_header = None
+        for name, value in scope["headers"]:
+            if name == b"authorization":
+                auth_header = value.decode("latin-1")
+                break
 
-        # 提取Authorization header
-        auth_header = request.headers.get("authorization")
         if not auth_header:
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"error": "unauthorized", "detail": "Missing Authorization header"},
-            )
+            await _unauthorized("Missing Authorization header")(scope, receive, send)
+            return
 
         # 检查Bearer前缀
         parts = auth_header.split(" ", 1)
         if len(parts) != 2 or parts[0].lower() != "bearer":
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"error": "unauthorized", "detail": "Invalid Authorization header format"},
-            )
+            await _unauthorized("Invalid Authorization header format")(scope, receive, send)
+            return
 
         token = parts[1]
 
         # 校验Token
         user_info = await verify_token(token)
         if not user_info:
-            return JSONResponse(
-                status_code=status.HTTP_401_UNAUTHORIZED,
-                content={"error": "unauthorized", "detail": "Invalid or expired token"},
-            )
+            await _unauthorized("Invalid or expired token")(scope, receive, send)
+            return
 
-        # 注入用户信息到request.state
-        request.state.user = user_info
+        # 注入用户信息到request.state（Request.state 读取 scope["state"]）
+        scope.setdefault("state", {})["user"] = user_info
 
-        return await call_next(request)
+        await self.app(scope, receive, send)
@@ -1,5 +1,8 @@
 """
 Pydantic模型定义
+
+响应模型（TokenResponse/LectureInfo）由 main.py 用 model_construct 从自家 SQL 结果构造，跳过校验；
+字段名必须与 auth/lectures 返回的 dict 键保持一致
 """
 from __future__ import annotations
 
@@ -10,7 +10,9 @@
 """
 from __future__ import annotations
 
+import asyncio
 import os
+import re
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -24,10 +26,26 @@ UPLOADS_DIR = STORAGE_ROOT / "uploads"
 EXPIRE_DAYS = int(os.environ.get("STORAGE_EXPIRE_DAYS", "7"))
 
 
+# 合法文件名：单层、仅 ASCII 字母数字与 ._-，不含 "/"，无需 resolve() 即可排除路径穿越
+# 含空格、中文等字符的文件名会被拒绝，调用方需自行生成安全文件名（如时间戳/UUID）
+_SAFE_NAME = re.compile(r"[A-Za-z0-9._-]{1,200}")
+
+# URI 前缀 → 存储目录（init_storage 后替换为 resolve 过的绝对路径，只解析一次）
+_BASE_DIRS: dict[str, Path] = {"exports": EXPORTS_DIR, "uploads": UPLOADS_DIR}
+
+
+def _check_name(name: str) -> None:
+    # fullmatch：$ 会放过结尾的换行符
+    if not _SAFE_NAME.fullmatch(name) or name in (".", ".."):
+        raise ValueError(f"Invalid filename: {name}")
+
+
 def init_storage() -> None:
     """初始化存储目录"""
     EXPORTS_DIR.mkdir(parents=True, exist_ok=True)
     UPLOADS_DIR.mkdir(parents=True, exist_ok=True)
+    _BASE_DIRS["exports"] = EXPORTS_DIR.resolve()
+    _BASE_DIRS["uploads"] = UPLOADS_DIR.resolve()
 
 
 def save_file(file_type: str, filename: str, content: bytes) -> str:
@@ -35,24 +53,16 @@ def save_file(file_type: str, filename: str, content: bytes) -> str:
     保存文件到本地存储
 
     file_type: 'export' 或 'upload'
-    filename: 文件名（建议带时间戳或UUID避免冲突）
+    filename: 文件名（建议带时间戳或UUID避免冲突；仅允许 ASCII 字母数字与 ._-，含空格或中文的名称会抛 ValueError）
     content: 文件内容
 
     返回：文件URI（相对路径，如 exports/xxx.md）
     """
     # 安全检查：禁止路径穿越
-    if ".." in filename or filename.startswith("/"):
-        raise ValueError(f"Invalid filename: {filename}")
-
-    base_dir = EXPORTS_DIR if file_type == "export" else UPLOADS_DIR
-    file_path = base_dir / filename
+    _check_name(filename)
 
-    # 再次检查resolve后的路径仍在base_dir内
-    resolved_path = file_path.resolve()
-    if not str(resolved_path).startswith(str(base_dir.resolve())):
-        raise ValueError(f"Path traversal attempt detected: {filename}")
-
-    file_path.write_bytes(content)
+    base_dir = _BASE_DIRS["exports"] if file_type == "export" else _BASE_DIRS["uploads"]
+    (base_dir / filename).write_bytes(content)
 
     # 返回相对URI
     return f"{file_type}s/{filename}"
@@ -64,18 +74,14 @@ def get_file_path(file_uri: str) -> Path:
 
     file_uri: 如 exports/xxx.md 或 uploads/yyy.wav
     """
-    # 安全检查：禁止路径穿越
-    if ".." in file_uri or file_uri.startswith("/"):
+    # 安全检查：只接受 save_file 生成的 “目录/文件名” 形式
+    kind, _, name = file_uri.partition("/")
+    base_dir = _BASE_DIRS.get(kind)
+    if base_dir is None:
         raise ValueError(f"Invalid file_uri: {file_uri}")
+    _check_name(name)
 
-    file_path = STORAGE_ROOT / file_uri
-
-    # 再次检查resolve后的路径仍在STORAGE_ROOT内
-    resolved_path = file_path.resolve()
-    if not str(resolved_path).startswith(str(STORAGE_ROOT.resolve())):
-        raise ValueError(f"Path traversal attempt detected: {file_uri}")
-
-    return file_path
+    return base_dir / name
 
 
 def delete_file(file_uri: str) -> bool:
@@ -92,28 +98,29 @@ def delete_file(file_uri: str) -> bool:
     return True
 
 
+def _cleanup_dir(directory: Path, cutoff_timestamp: float) -> int:
+    """删除目录下修改时间早于cutoff的普通文件，返回删除数（DirEntry 自带类型信息，少一次 stat）"""
+    deleted = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.is_file(follow_symlinks=False) and entry.stat(follow_symlinks=False).st_mtime < cutoff_timestamp:
+                os.unlink(entry.path)
+                deleted += 1
+    return deleted
+
+
 async def cleanup_expired_files() -> tuple[int, int]:
     """
     清理过期文件（超过EXPIRE_DAYS天的文件）
 
+    文件系统操作在线程中执行，不阻塞事件循环
+
     返回：(导出文件删除数, 上传文件删除数)
     """
     cutoff_time = datetime.now() - timedelta(days=EXPIRE_DAYS)
     cutoff_timestamp = cutoff_time.timestamp()
 
-    exports_deleted = 0
-    uploads_deleted = 0
-
-    # 清理导出文件
-    for file_path in EXPORTS_DIR.iterdir():
-        if file_path.is_file() and file_path.stat().st_mtime < cutoff_timestamp:
-            file_path.unlink()
-            exports_deleted += 1
-
-    # 清理上传文件
-    for file_path in UPLOADS_DIR.iterdir():
-        if file_path.is_file() and file_path.stat().st_mtime < cutoff_timestamp:
-            file_path.unlink()
-            uploads_deleted += 1
+    exports_deleted = await asyncio.to_thread(_cleanup_dir, EXPORTS_DIR, cutoff_timestamp)
+    uploads_deleted = await asyncio.to_thread(_cleanup_dir, UPLOADS_DIR, cutoff_timestamp)
 
     return exports_deleted, uploads_deleted
@@ -25,6 +25,12 @@ _queue: asyncio.Queue[tuple[Callable[..., Awaitable[Any]], tuple[Any, ...], dict
 # worker任务列表
 _workers: list[asyncio.Task] | None = None
 
+# 队列上限：积压超过该值说明下游跟不上，新任务直接丢弃而不是无限堆内存
+QUEUE_MAXSIZE = 1024
+
+# 因队列已满被丢弃的任务数
+_dropped = 0
+
 
 async def _worker(worker_id: int) -> None:
     """
@@ -65,7 +71,7 @@ def start_workers(num_workers: int = 2) -> None:
     if _queue is not None:
         return  # 已启动
 
-    _queue = asyncio.Queue()
+    _queue = asyncio.Queue(maxsize=QUEUE_MAXSIZE)
     _workers = []
 
     for i in range(num_workers):
@@ -114,16 +120,24 @@ async def stop_workers(timeout: float = 5.0) -> None:
     logger.info("Workers stopped")
 
 
-def submit_task(func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> None:
+def submit_task(func: Callable[..., Awaitable[Any]], *args: Any, **kwargs: Any) -> bool:
     """
     提交异步任务到队列
 
+    返回 True（已入队）或 False（队列已满，任务被丢弃）
+
     示例：
         submit_task(process_audio, lecture_id=1, audio_bytes=b"...")
     """
-    global _queue
+    global _queue, _dropped
 
     if _queue is None:
         raise RuntimeError("Workers not started. Call start_workers() first.")
 
-    _queue.put_nowait((func, args, kwargs))
+    try:
+        _queue.put_nowait((func, args, kwargs))
+        return True
+    except asyncio.QueueFull:
+        _dropped += 1
+        logger.warning(f"Task queue full, dropped {getattr(func, '__name__', func)} (total dropped: {_dropped})")
+        return False
@@ -5,13 +5,18 @@
 - 英译中（en → zh）
 - 超时重试
 - 错误处理
+- 并发请求合并（多行 q 一次请求）
+- 翻译结果 LRU 缓存（课堂里大量重复的短句）
 """
 from __future__ import annotations
 
+import asyncio
 import hashlib
 import logging
 import os
-import random
+import secrets
+import string
+from collections import OrderedDict
 from typing import Any
 
 import httpx
@@ -25,6 +30,54 @@ BAIDU_API_URL = "https://fanyi-api.baidu.com/api/trans/vip/translate"
 TRANSLATE_TIMEOUT = float(os.getenv("TRANSLATE_TIMEOUT", "5.0"))
 TRANSLATE_RETRIES = int(os.getenv("TRANSLATE_RETRIES", "2"))
 
+# 批量合并：第一条请求到达后最多等待的秒数、单批最大条数
+BATCH_WAIT = float(os.getenv("TRANSLATE_BATCH_WAIT_MS", "50")) / 1000
+BATCH_SIZE = int(os.getenv("TRANSLATE_BATCH_SIZE", "16"))
+
+# 翻译结果缓存：(from_lang, to_lang, text) → 译文，仅缓存成功结果
+CACHE_SIZE = 4096
+_cache: OrderedDict[tuple[str, str, str], str] = OrderedDict()
+
+# 不含任何字母的文本（标点、数字、空白）无需翻译，原样返回
+_NO_LETTERS = frozenset(string.punctuation + string.digits + string.whitespace)
+
+# 全局 HTTP 客户端：复用 keep-alive 连接，避免每条字幕（及每次重试）都重新 TCP+TLS 握手
+_client: httpx.AsyncClient | None = None
+
+
+def _get_client() -> httpx.AsyncClient:
+    """获取全局 HTTP 客户端，首次调用时创建"""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            timeout=TRANSLATE_TIMEOUT,
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+    return _client
+
+
+# 待合并的翻译请求：(text, from_lang, to_lang, future)
+_pending: asyncio.Queue[tuple[str, str, str, asyncio.Future]] | None = None
+_batch_task: asyncio.Task | None = None
+_inflight: set[asyncio.Task] = set()
+
+
+async def close_client() -> None:
+    """停止批处理任务并关闭 HTTP 客户端（用于优雅退出）"""
+    global _client, _pending, _batch_task
+    if _batch_task is not None:
+        _batch_task.cancel()
+        _batch_task = None
+        _pending = None
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+# 签名的固定前缀（appid）预先哈希，每次只需 copy 后追加可变部分
+_md5_prefix = hashlib.md5(BAIDU_APPID.encode("utf-8"))
+_secret_bytes = BAIDU_SECRET.encode("utf-8")
+
 
 def _generate_sign(query: str, salt: str) -> str:
     """
@@ -32,41 +85,33 @@ def _generate_sign(query: str, salt: str) -> str:
 
     签名算法：MD5(appid+q+salt+密钥)
     """
-    sign_str = f"{BAIDU_APPID}{query}{salt}{BAIDU_SECRET}"
-    return hashlib.md5(sign_str.encode("utf-8")).hexdigest()
+    h = _md5_prefix.copy()
+    h.update(query.encode("utf-8"))
+    h.update(salt.encode("utf-8"))
+    h.update(_secret_bytes)
+    return h.hexdigest()
 
 
-async def translate_text(text: str, from_lang: str = "en", to_lang: str = "zh") -> dict[str, Any]:
+async def _request(query: str, from_lang: str, to_lang: str) -> dict[str, Any]:
     """
-    翻译文本（英译中）
-
-    Args:
-        text: 待翻译文本
-        from_lang: 源语言（默认 en）
-        to_lang: 目标语言（默认 zh）
+    发起一次签名请求（带重试）
 
     Returns:
         {
-            "text": str,       # 翻译结果，空字符串表示失败
-            "error": str|None, # 错误信息
-            "code": int|None   # 错误码（3001=translate_failed）
+            "lines": list[str], # 按行对应的翻译结果（百度对 q 中每一行返回一条 trans_result）
+            "error": str|None,
+            "code": int|None
         }
     """
-    if not BAIDU_APPID or not BAIDU_SECRET:
-        return {"text": "", "error": "translate_not_configured", "code": 3001}
-
-    if not text.strip():
-        return {"text": "", "error": None, "code": None}
-
     # 生成随机盐值
-    salt = str(random.randint(32768, 65536))
+    salt = str(secrets.randbelow(32769) + 32768)
 
     # 生成签名
-    sign = _generate_sign(text, salt)
+    sign = _generate_sign(query, salt)
 
-    # 构造请求参数
+    # 构造请求参数（POST 表单，批量拼接后的 q 可能超出 URL 长度限制）
     params = {
-        "q": text,
+        "q": query,
         "from": from_lang,
         "to": to_lang,
         "appid": BAIDU_APPID,
@@ -74,39 +119,148 @@ async def translate_text(text: str, from_lang: str = "en", to_lang: str = "zh")
         "sign": sign,
     }
 
-    # 发起请求（带重试）
+    # 发起请求（带重试，重试复用同一连接）
+    client = _get_client()
     for attempt in range(TRANSLATE_RETRIES + 1):
         try:
-            async with httpx.AsyncClient() as client:
-                response = await client.get(BAIDU_API_URL, params=params, timeout=TRANSLATE_TIMEOUT)
-                response.raise_for_status()
+            response = await client.post(BAIDU_API_URL, data=params)
+            response.raise_for_status()
 
-                data = response.json()
+            data = response.json()
 
-                # 检查错误码
-                if "error_code" in data:
-                    error_code = data["error_code"]
-                    error_msg = data.get("error_msg", "Unknown error")
-                    logger.warning(f"Baidu translate error: {error_code} - {error_msg}")
-                    return {"text": "", "error": f"baidu_error_{error_code}", "code": 3001}
+            # 检查错误码
+            if "error_code" in data:
+                error_code = data["error_code"]
+                error_msg = data.get("error_msg", "Unknown error")
+                logger.warning(f"Baidu translate error: {error_code} - {error_msg}")
+                return {"lines": [], "error": f"baidu_error_{error_code}", "code": 3001}
 
-                # 提取翻译结果
-                trans_result = data.get("trans_result", [])
-                if not trans_result:
-                    return {"text": "", "error": "empty_result", "code": 3001}
+            # 提取翻译结果
+            trans_result = data.get("trans_result", [])
+            if not trans_result:
+                return {"lines": [], "error": "empty_result", "code": 3001}
 
-                translated = trans_result[0].get("dst", "")
-                return {"text": translated, "error": None, "code": None}
+            return {"lines": [item.get("dst", "") for item in trans_result], "error": None, "code": None}
 
         except httpx.TimeoutException:
             if attempt < TRANSLATE_RETRIES:
                 logger.warning(f"Translate timeout, retrying ({attempt + 1}/{TRANSLATE_RETRIES})...")
                 continue
             logger.error("Translate timeout after retries")
-            return {"text": "", "error": "translate_timeout", "code": 3001}
+            return {"lines": [], "error": "translate_timeout", "code": 3001}
 
         except Exception as exc:
             logger.error(f"Translate failed: {exc}", exc_info=True)
-            return {"text": "", "error": f"translate_failed: {exc}", "code": 3001}
+            return {"lines": [], "error": f"translate_failed: {exc}", "code": 3001}
+
+    return {"lines": [], "error": "translate_failed", "code": 3001}
+
+
+async def _dispatch(from_lang: str, to_lang: str, items: list[tuple[str, asyncio.Future]]) -> None:
+    """把同一语言对的一批文本拼成一次请求，按行拆分结果并逐个完成 future"""
+    futures = [future for _, future in items]
+    try:
+        # 单条文本内的换行会打乱行对应关系，先压成空格
+        texts = [" ".join(text.splitlines()) for text, _ in items]
+        result = await _request("\n".join(texts), from_lang, to_lang)
+        lines = result["lines"]
+
+        if result["code"] is None and len(lines) != len(texts):
+            # 行数对不上（极少见），退回逐条请求
+            logger.warning(f"Batch translate returned {len(lines)} lines for {len(texts)} texts, retrying one by one")
+            for single, future in zip(texts, futures):
+                r = await _request(single, from_lang, to_lang)
+                if not future.done():
+                    future.set_result({"text": (r["lines"] or [""])[0], "error": r["error"], "code": r["code"]})
+            return
+
+        for i, future in enumerate(futures):
+            if future.done():
+                continue  # 调用方已取消
+            if result["code"] is not None:
+                future.set_result({"text": "", "error": result["error"], "code": result["code"]})
+            else:
+                future.set_result({"text": lines[i], "error": None, "code": None})
+    except Exception as exc:
+        logger.error(f"Batch translate failed: {exc}", exc_info=True)
+    finally:
+        # 兜底：任何未完成的 future 都必须有结果，否则调用方会永远等待
+        for future in futures:
+            if not future.done():
+                future.set_result({"text": "", "error": "translate_failed", "code": 3001})
+
+
+async def _batch_loop() -> None:
+    """
+    合并并发的翻译请求：第一条到达后最多再等 BATCH_WAIT 秒，攒够 BATCH_SIZE 条或时间到即发出
+
+    发送在独立任务中进行，不阻塞下一批的收集
+    """
+    assert _pending is not None
+    while True:
+        batch = [await _pending.get()]
+        while len(batch) < BATCH_SIZE and not _pending.empty():
+            batch.append(_pending.get_nowait())
+        if len(batch) < BATCH_SIZE:
+            await asyncio.sleep(BATCH_WAIT)
+            while len(batch) < BATCH_SIZE and not _pending.empty():
+                batch.append(_pending.get_nowait())
+
+        groups: dict[tuple[str, str], list[tuple[str, asyncio.Future]]] = {}
+        for text, from_lang, to_lang, future in batch:
+            groups.setdefault((from_lang, to_lang), []).append((text, future))
+
+        for (from_lang, to_lang), items in groups.items():
+            task = asyncio.create_task(_dispatch(from_lang, to_lang, items))
+            _inflight.add(task)
+            task.add_done_callback(_inflight.discard)
+
+
+async def translate_text(text: str, from_lang: str = "en", to_lang: str = "zh") -> dict[str, Any]:
+    """
+    翻译文本（英译中）
+
+    命中缓存直接返回；未命中的并发调用会在 BATCH_WAIT 窗口内合并为一次百度请求（多行 q），对调用方透明
+
+    Args:
+        text: 待翻译文本
+        from_lang: 源语言（默认 en）
+        to_lang: 目标语言（默认 zh）
+
+    Returns:
+        {
+            "text": str,       # 翻译结果，空字符串表示失败
+            "error": str|None, # 错误信息
+            "code": int|None   # 错误码（3001=translate_failed）
+        }
+    """
+    global _pending, _batch_task
+
+    if not BAIDU_APPID or not BAIDU_SECRET:
+        return {"text": "", "error": "translate_not_configured", "code": 3001}
+
+    if not text.strip():
+        return {"text": "", "error": None, "code": None}
+
+    if _NO_LETTERS.issuperset(text):
+        return {"text": text.strip(), "error": None, "code": None}
+
+    key = (from_lang, to_lang, text)
+    cached = _cache.get(key)
+    if cached is not None:
+        _cache.move_to_end(key)
+        return {"text": cached, "error": None, "code": None}
+
+    if _batch_task is None:
+        _pending = asyncio.Queue()
+        _batch_task = asyncio.create_task(_batch_loop())
+
+    future: asyncio.Future[dict[str, Any]] = asyncio.get_running_loop().create_future()
+    _pending.put_nowait((text, from_lang, to_lang, future))
+    result = await future
 
-    return {"text": "", "error": "translate_failed", "code": 3001}
+    if result["code"] is None and result["text"]:
+        _cache[key] = result["text"]
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
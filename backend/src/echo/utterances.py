@@ -1,75 +1,89 @@
 """
 Utterance 数据库操作
+
+实时字幕落库走批量写入：enqueue_utterance()/enqueue_translation() 只入队，
+后台 writer 每 FLUSH_INTERVAL 秒或攒够 BATCH_SIZE 条用 executemany 一次写入；
+同一批内已到达的翻译直接并入插入行，不再单独 UPDATE
 """
 from __future__ import annotations
 
+import asyncio
 import logging
 from typing import Any
 
 logger = logging.getLogger(__name__)
 
+# 批量写入参数
+FLUSH_INTERVAL = 0.1
+BATCH_SIZE = 64
+# 队列上限：数据库跟不上时丢弃新写入（字幕已通过广播送达），不让积压拖垮进程
+BUFFER_MAXSIZE = 4096
 
-async def create_utterance(
-    pool: Any,
-    lecture_id: int,
-    seq: int,
-    start_ms: int,
-    end_ms: int,
-    text_en: str,
-    text_zh: str = "",
-    source: str = "realtime"
-) -> None:
-    """
-    插入 utterance 记录
+_INSERT_SQL = """
+    INSERT INTO utterances (lecture_id, seq, start_ms, end_ms, text_en, text_zh, source)
+    VALUES (%s, %s, %s, %s, %s, %s, %s)
+    ON CONFLICT (lecture_id, seq, source) DO UPDATE
+    SET text_zh = EXCLUDED.text_zh
+    WHERE COALESCE(utterances.text_zh, '') = '' AND EXCLUDED.text_zh <> ''
+"""
 
-    Args:
-        pool: psycopg3 连接池
-        lecture_id: 讲座 ID
-        seq: 序号（单调递增）
-        start_ms: 开始时间（毫秒）
-        end_ms: 结束时间（毫秒）
-        text_en: 英文文本
-        text_zh: 中文翻译（可选）
-        source: 来源（realtime/reprocess）
-    """
-    sql = """
-        INSERT INTO utterances (lecture_id, seq, start_ms, end_ms, text_en, text_zh, source)
-        VALUES (%s, %s, %s, %s, %s, %s, %s)
-        ON CONFLICT (lecture_id, seq, source) DO NOTHING
-    """
-    try:
-        async with pool.connection() as conn:
-            await conn.execute(sql, (lecture_id, seq, start_ms, end_ms, text_en, text_zh, source))
-    except Exception as exc:
-        logger.error(f"Failed to create utterance: {exc}", exc_info=True)
+_UPDATE_TRANSLATION_SQL = """
+    UPDATE utterances
+    SET text_zh = %s
+    WHERE lecture_id = %s AND seq = %s AND source = %s
+"""
 
+_LIST_SQL = """
+    SELECT seq, start_ms, end_ms, text_en, text_zh
+    FROM utterances
+    WHERE lecture_id = %s AND source = %s
+    ORDER BY seq ASC
+    LIMIT %s OFFSET %s
+"""
 
-async def get_max_seq(pool: Any, lecture_id: int, source: str = "realtime") -> int:
-    """
-    获取指定讲座的最大 seq（用于服务器重启时恢复）
+_LIST_AFTER_SQL = """
+    SELECT seq, start_ms, end_ms, text_en, text_zh
+    FROM utterances
+    WHERE lecture_id = %s AND source = %s AND seq > %s
+    ORDER BY seq ASC
+    LIMIT %s
+"""
 
-    Args:
-        pool: psycopg3 连接池
-        lecture_id: 讲座 ID
-        source: 来源（realtime/reprocess）
+# 待写入队列：("insert", 参数元组) 或 ("translation", 参数元组)
+# 同一条字幕的翻译一定在插入之后入队，FIFO 保证先插入后更新
+_buffer: asyncio.Queue[tuple[str, tuple[Any, ...]]] | None = None
+_writer: asyncio.Task | None = None
+
+# 停止标记：stop_writer 入队，writer 写完手头的批次后退出
+_STOP: tuple[str, tuple[Any, ...]] = ("stop", ())
+
+# 因队列已满被丢弃的写入数
+_dropped = 0
+
+
+async def get_max_seq_batch(pool: Any, lecture_ids: list[int], source: str = "realtime") -> dict[int, int]:
+    """
+    批量获取多个讲座的最大 seq（一次查询，用于同时开始的多个讲座）
 
     Returns:
-        最大 seq，如果没有记录返回 0
+        {lecture_id: 最大 seq}，没有记录的讲座为 0
+
+    Raises:
+        psycopg.Error: 查询失败（由调用方决定如何处理）
     """
     sql = """
-        SELECT COALESCE(MAX(seq), 0) as max_seq
+        SELECT lecture_id, MAX(seq)
         FROM utterances
-        WHERE lecture_id = %s AND source = %s
+        WHERE lecture_id = ANY(%s) AND source = %s
+        GROUP BY lecture_id
     """
-    try:
-        async with pool.connection() as conn:
-            async with conn.cursor() as cur:
-                await cur.execute(sql, (lecture_id, source))
-                row = await cur.fetchone()
-                return row[0] if row else 0
-    except Exception as exc:
-        logger.error(f"Failed to get max seq: {exc}", exc_info=True)
-        return 0
+    result = dict.fromkeys(lecture_ids, 0)
+    async with pool.connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.execute(sql, (lecture_ids, source))
+            for lecture_id, max_seq in await cur.fetchall():
+                result[lecture_id] = max_seq
+    return result
 
 
 async def list_utterances(
@@ -77,32 +91,33 @@ async def list_utterances(
     lecture_id: int,
     source: str = "realtime",
     limit: int = 1000,
-    offset: int = 0
+    offset: int = 0,
+    after_seq: int | None = None
 ) -> list[dict[str, Any]]:
     """
     查询讲座的历史字幕列表
 
+    走 (lecture_id, source, seq) 索引；翻页优先用 after_seq（keyset），深翻页不再扫描被跳过的行
+
     Args:
         pool: psycopg3 连接池
         lecture_id: 讲座 ID
         source: 来源（realtime/reprocess）
         limit: 最大返回数量
-        offset: 偏移量
+        offset: 偏移量（传 after_seq 时忽略）
+        after_seq: 只返回 seq 大于该值的记录（上一页最后一条的 seq）
 
     Returns:
         字幕列表 [{"seq": int, "start_ms": int, "end_ms": int, "text_en": str, "text_zh": str|None}, ...]
     """
-    sql = """
-        SELECT seq, start_ms, end_ms, text_en, text_zh
-        FROM utterances
-        WHERE lecture_id = %s AND source = %s
-        ORDER BY seq ASC
-        LIMIT %s OFFSET %s
-    """
+    if after_seq is not None:
+        sql, params = _LIST_AFTER_SQL, (lecture_id, source, after_seq, limit)
+    else:
+        sql, params = _LIST_SQL, (lecture_id, source, limit, offset)
     try:
         async with pool.connection() as conn:
             async with conn.cursor() as cur:
-                await cur.execute(sql, (lecture_id, source, limit, offset))
+                await cur.execute(sql, params)
                 rows = await cur.fetchall()
                 return [
                     {
@@ -119,31 +134,142 @@ async def list_utterances(
         return []
 
 
-async def update_translation(
-    pool: Any,
+def enqueue_utterance(
     lecture_id: int,
     seq: int,
-    text_zh: str,
+    start_ms: int,
+    end_ms: int,
+    text_en: str,
+    text_zh: str = "",
     source: str = "realtime"
-) -> None:
-    """
-    更新字幕的中文翻译（异步翻译完成后调用）
+) -> bool:
+    """插入 utterance（入队，由后台 writer 批量落库），返回 False 表示队列已满被丢弃"""
+    return _enqueue("insert", (lecture_id, seq, start_ms, end_ms, text_en, text_zh, source))
 
-    Args:
-        pool: psycopg3 连接池
-        lecture_id: 讲座 ID
-        seq: 序号
-        text_zh: 中文翻译
-        source: 来源（realtime/reprocess）
+
+def enqueue_translation(lecture_id: int, seq: int, text_zh: str, source: str = "realtime") -> bool:
+    """更新中文翻译（入队，由后台 writer 批量落库），返回 False 表示队列已满被丢弃"""
+    return _enqueue("translation", (text_zh, lecture_id, seq, source))
+
+
+def _enqueue(kind: str, params: tuple[Any, ...]) -> bool:
+    global _dropped
+
+    if _buffer is None:
+        raise RuntimeError("Utterance writer not started. Call start_writer() first.")
+
+    try:
+        _buffer.put_nowait((kind, params))
+        return True
+    except asyncio.QueueFull:
+        _dropped += 1
+        logger.warning(f"Utterance buffer full, dropped {kind} write (total dropped: {_dropped})")
+        return False
+
+
+def _drain(batch: list[tuple[str, tuple[Any, ...]]]) -> None:
+    while len(batch) < BATCH_SIZE and not _buffer.empty():
+        batch.append(_buffer.get_nowait())
+
+
+async def _write_batch(pool: Any, batch: list[tuple[str, tuple[Any, ...]]]) -> None:
     """
-    sql = """
-        UPDATE utterances
-        SET text_zh = %s
-        WHERE lecture_id = %s AND seq = %s AND source = %s
+    一个事务内先批量插入、再批量更新翻译（executemany 自动走 pipeline）
+
+    翻译对应的插入行还在同一批里时，直接写进插入行的 text_zh，省掉一条 UPDATE
     """
+    pending: dict[tuple[Any, ...], list[Any]] = {}
+    translations = []
+    for kind, params in batch:
+        if kind == "insert":
+            lecture_id, seq, _, _, _, _, source = params
+            pending[(lecture_id, seq, source)] = list(params)
+        else:
+            text_zh, lecture_id, seq, source = params
+            row = pending.get((lecture_id, seq, source))
+            if row is not None:
+                row[5] = text_zh
+            else:
+                translations.append(params)
+    inserts = [tuple(row) for row in pending.values()]
     try:
         async with pool.connection() as conn:
-            await conn.execute(sql, (text_zh, lecture_id, seq, source))
-            logger.debug(f"Updated translation for lecture {lecture_id} seq {seq}")
+            async with conn.cursor() as cur:
+                if inserts:
+                    await cur.executemany(_INSERT_SQL, inserts)
+                if translations:
+                    await cur.executemany(_UPDATE_TRANSLATION_SQL, translations)
+    except Exception as exc:
+        # 整批回滚了：逐条重试，只丢真正写不进去的那一条
+        logger.warning(f"Failed to write {len(batch)} utterance rows, retrying one by one: {exc}")
+        await _write_rows(pool, inserts, translations)
+
+
+async def _write_rows(pool: Any, inserts: list[tuple[Any, ...]], translations: list[tuple[Any, ...]]) -> None:
+    """逐条写入，每条单独事务，失败只记录日志"""
+    statements = [(_INSERT_SQL, params) for params in inserts]
+    statements += [(_UPDATE_TRANSLATION_SQL, params) for params in translations]
+    try:
+        async with pool.connection() as conn:
+            for sql, params in statements:
+                try:
+                    async with conn.transaction():
+                        await conn.execute(sql, params)
+                except Exception as exc:
+                    logger.error(f"Failed to write utterance row {params}: {exc}", exc_info=True)
     except Exception as exc:
-        logger.error(f"Failed to update translation: {exc}", exc_info=True)
+        logger.error(f"Failed to write {len(statements)} utterance rows: {exc}", exc_info=True)
+
+
+async def _writer_loop(pool: Any) -> None:
+    """
+    后台 writer：第一条到达后最多等 FLUSH_INTERVAL 秒，攒够 BATCH_SIZE 条或时间到即写入
+
+    取到停止标记时写完手头这一批再退出（不能直接 cancel，已出队的记录只在本地 batch 里）
+    """
+    while True:
+        batch = [await _buffer.get()]
+        _drain(batch)
+        if len(batch) < BATCH_SIZE and _STOP not in batch:
+            await asyncio.sleep(FLUSH_INTERVAL)
+            _drain(batch)
+        stop = _STOP in batch
+        if stop:
+            batch = [item for item in batch if item is not _STOP]
+        if batch:
+            await _write_batch(pool, batch)
+        if stop:
+            return
+
+
+def start_writer(pool: Any) -> None:
+    """启动后台批量 writer"""
+    global _buffer, _writer
+
+    if _writer is not None:
+        return  # 已启动
+
+    _buffer = asyncio.Queue(maxsize=BUFFER_MAXSIZE)
+    _writer = asyncio.create_task(_writer_loop(pool))
+    logger.info("Utterance writer started")
+
+
+async def stop_writer(pool: Any) -> None:
+    """停止 writer，并把队列中剩余的记录写完"""
+    global _buffer, _writer
+
+    if _writer is None:
+        return
+
+    await _buffer.put(_STOP)
+    await _writer
+
+    # 停止标记之后才入队的记录
+    while not _buffer.empty():
+        batch: list[tuple[str, tuple[Any, ...]]] = []
+        _drain(batch)
+        await _write_batch(pool, batch)
+
+    _buffer = None
+    _writer = None
+    logger.info("Utterance writer stopped")
@@ -1,27 +1,118 @@
 """
 WebSocket房间管理与心跳机制
+
+每个连接加入房间时分配一个发送队列和一个常驻发送任务：
+broadcast() 只把序列化好的文本放进各连接的队列，由发送任务串行写出，
+慢连接只会积压自己的队列，不会拖慢广播方，也不必每条消息为每个接收者创建任务
 """
 from __future__ import annotations
 
 import asyncio
+import itertools
 import logging
-from collections import defaultdict
+from collections.abc import AsyncIterator, Callable
 from typing import Any
 
+import orjson
 from fastapi import WebSocket
 
 from echo.auth import verify_token
 
 logger = logging.getLogger(__name__)
 
-# lecture_id → set of WebSocket连接
-_rooms: dict[int, set[WebSocket]] = defaultdict(set)
+# lecture_id → 房间内 WebSocket 连接（不可变 tuple，加入/离开时在锁内整体替换；
+# broadcast 无锁读取当前引用即可得到一致快照，每条消息不再加锁、复制列表）
+_rooms: dict[int, tuple[WebSocket, ...]] = {}
+
+# lecture_id → seq 计数器（next() 即取号，单线程事件循环内无需加锁）
+# 房间清空后也保留（每个讲座一个计数器对象），进程内只在首次使用时从数据库恢复
+_seq_counters: dict[int, itertools.count] = {}
+
+# WebSocket → 发送队列 / 发送任务（_senders 同时充当房间成员的哈希索引：连接在房间内当且仅当有发送任务，
+# join/leave 的成员判断 O(1)，不用线性扫描房间 tuple）
+_send_queues: dict[WebSocket, asyncio.Queue[str]] = {}
+_senders: dict[WebSocket, asyncio.Task] = {}
+
+# 心跳：一个共享任务定时给所有连接发 ping（不再每个连接一个 sleep 任务）
+HEARTBEAT_INTERVAL = 30.0
+_heartbeat_task: asyncio.Task | None = None
+
+# 后台任务（关闭慢连接、延迟广播），持有引用避免被回收
+_background: set[asyncio.Task] = set()
+
+# subtitle_partial 合并窗口（秒）：窗口内同一讲座的多条 partial 只广播最后一条
+PARTIAL_COALESCE = 0.02
+_pending_partials: dict[int, dict[str, Any]] = {}
+_partial_timers: dict[int, asyncio.TimerHandle] = {}
+
+# 单个连接最多积压的待发送消息数，超出说明客户端跟不上，将其踢出（客户端会自动重连）
+SEND_QUEUE_SIZE = 64
+# 单条消息发送超时（秒），超时视为连接已失效
+SEND_TIMEOUT = 3.0
+# 全进程同时进行中的 WebSocket 写入上限，避免一次广播后数百个发送任务同时写 socket
+SEND_CONCURRENCY = 32
+_send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+# 大房间广播时每入队这么多个连接让出一次事件循环，避免一次广播唤醒的发送任务挤占其他请求
+BROADCAST_BATCH = 50
+
+# 待初始化 seq 计数器的讲座：第一个请求到达后等 INIT_BATCH_WAIT 秒，合并为一次 get_max_seq_batch 查询
+INIT_BATCH_WAIT = 0.005
+_pending_init: dict[int, asyncio.Future[int]] = {}
+
+# lecture_id → 讲座锁（串行化该讲座 _rooms 的替换和 _seq_counters 的修改），不同讲座互不阻塞
+# 单线程事件循环内 setdefault 不会被打断，无需再用一把锁保护锁表；
+# 锁在讲座房间清空后也保留（每个讲座一个 Lock 对象），避免删掉仍有协程在等待的锁
+_locks: dict[int, asyncio.Lock] = {}
+
+
+def _lock_for(lecture_id: int) -> asyncio.Lock:
+    lock = _locks.get(lecture_id)
+    if lock is None:
+        lock = _locks.setdefault(lecture_id, asyncio.Lock())
+    return lock
+
+
+def encode_message(message: dict[str, Any]) -> str:
+    """
+    序列化出站消息（orjson 比 stdlib json 快数倍，且中文无需转义）
+
+    返回 str 以文本帧发送：前端对 event.data 直接 JSON.parse，二进制帧会解析失败
+    """
+    return orjson.dumps(message).decode()
+
 
-# lecture_id → seq 计数器
-_seq_counters: dict[int, int] = {}
+# 历史字幕回放时每块序列化的条数
+BACKFILL_CHUNK = 256
 
-# 全局锁（保护 _rooms 和 _seq_counters 的并发修改）
-_lock = asyncio.Lock()
+
+async def stream_backfill(lecture_id: int, utterances: list[dict[str, Any]]) -> AsyncIterator[bytes]:
+    """
+    把历史字幕序列化为与实时 subtitle 消息格式一致的 JSON 数组，分块输出
+
+    每 BACKFILL_CHUNK 条序列化一次并让出事件循环，长讲座回放时不会一次性生成整段大字符串、
+    也不会长时间占住事件循环。仍是 JSON 文本（前端直接 JSON.parse），不改用二进制格式
+    """
+    yield b"["
+    for i in range(0, len(utterances), BACKFILL_CHUNK):
+        chunk = orjson.dumps([
+            {
+                "type": "subtitle",
+                "lecture_id": lecture_id,
+                "seq": u["seq"],
+                "start_ms": u["start_ms"],
+                "end_ms": u["end_ms"],
+                "text_en": u["text_en"],
+                "text_zh": u["text_zh"],
+            }
+            for u in utterances[i:i + BACKFILL_CHUNK]
+        ])
+        yield (b"," if i else b"") + chunk[1:-1]
+        await asyncio.sleep(0)
+    yield b"]"
+
+
+# 心跳消息（固定内容，只序列化一次）
+_PING = encode_message({"type": "ping"})
 
 
 async def authenticate_ws(websocket: WebSocket) -> dict[str, Any] | None:
@@ -46,18 +137,43 @@ async def init_seq_counter(lecture_id: int, pool: Any) -> None:
         lecture_id: 讲座 ID
         pool: 数据库连接池
     """
-    from echo.utterances import get_max_seq
-
-    async with _lock:
+    async with _lock_for(lecture_id):
         if lecture_id not in _seq_counters:
-            max_seq = await get_max_seq(pool, lecture_id, source="realtime")
-            _seq_counters[lecture_id] = max_seq
+            max_seq = await _load_max_seq(lecture_id, pool)
+            _seq_counters[lecture_id] = itertools.count(max_seq + 1)
             logger.info(f"Initialized seq counter for lecture {lecture_id}: {max_seq}")
 
 
-async def next_seq(lecture_id: int) -> int:
+async def _load_max_seq(lecture_id: int, pool: Any) -> int:
+    """排队等待批量查询最大 seq"""
+    loop = asyncio.get_running_loop()
+    future = _pending_init.get(lecture_id)
+    if future is None:
+        future = _pending_init[lecture_id] = loop.create_future()
+        if len(_pending_init) == 1:
+            loop.call_later(INIT_BATCH_WAIT, lambda: _spawn(_flush_init(pool)))
+    return await future
+
+
+async def _flush_init(pool: Any) -> None:
+    """一次查询取出本批所有讲座的最大 seq 并唤醒等待方"""
+    from echo.utterances import get_max_seq_batch
+
+    batch = dict(_pending_init)
+    _pending_init.clear()
+    try:
+        max_seqs = await get_max_seq_batch(pool, list(batch), source="realtime")
+    except Exception as exc:
+        logger.error(f"Failed to get max seq for lectures {list(batch)}: {exc}", exc_info=True)
+        max_seqs = {}
+    for lecture_id, future in batch.items():
+        if not future.done():
+            future.set_result(max_seqs.get(lecture_id, 0))
+
+
+def next_seq(lecture_id: int) -> int:
     """
-    获取下一个 seq（线程安全）
+    获取下一个 seq（同步取号，不加锁）
 
     Args:
         lecture_id: 讲座 ID
@@ -65,71 +181,199 @@ async def next_seq(lecture_id: int) -> int:
     Returns:
         新的 seq 值
     """
-    async with _lock:
-        _seq_counters[lecture_id] = _seq_counters.get(lecture_id, 0) + 1
-        return _seq_counters[lecture_id]
+    counter = _seq_counters.get(lecture_id)
+    if counter is None:
+        counter = _seq_counters.setdefault(lecture_id, itertools.count(1))
+    return next(counter)
+
+
+async def _close_quietly(websocket: WebSocket, code: int, reason: str) -> None:
+    """关闭连接（带超时），连接可能已断开，忽略异常"""
+    try:
+        async with asyncio.timeout(SEND_TIMEOUT):
+            await websocket.close(code=code, reason=reason)
+    except Exception:
+        pass
+
+
+async def _sender_loop(websocket: WebSocket, queue: asyncio.Queue[str]) -> None:
+    """连接的常驻发送任务：按入队顺序逐条发送，发送失败或超时即离开房间并关闭连接"""
+    while True:
+        payload = await queue.get()
+        try:
+            # 超时只计实际写入时间，排队等待信号量不算，避免繁忙时误踢健康连接
+            async with _send_sem:
+                async with asyncio.timeout(SEND_TIMEOUT):
+                    await websocket.send_text(payload)
+        except Exception as exc:
+            logger.warning(f"Failed to broadcast to client: {exc}")
+            await leave_current_room(websocket)
+            await _close_quietly(websocket, 1011, "Send failed")
+            return
 
 
 async def join_room(lecture_id: int, websocket: WebSocket) -> None:
-    """加入讲座房间"""
-    async with _lock:
-        _rooms[lecture_id].add(websocket)
+    """加入讲座房间，并启动该连接的发送任务（心跳随之开始）"""
+    global _heartbeat_task
+    if _heartbeat_task is None:
+        _heartbeat_task = asyncio.create_task(_heartbeat_loop(HEARTBEAT_INTERVAL))
+
+    async with _lock_for(lecture_id):
+        if websocket in _senders:
+            return  # 已在房间内
+        _rooms[lecture_id] = _rooms.get(lecture_id, ()) + (websocket,)
+        websocket.state.lecture_id = lecture_id
+        queue: asyncio.Queue[str] = asyncio.Queue(maxsize=SEND_QUEUE_SIZE)
+        _send_queues[websocket] = queue
+        _senders[websocket] = asyncio.create_task(_sender_loop(websocket, queue))
 
 
 async def leave_room(lecture_id: int, websocket: WebSocket) -> None:
-    """离开讲座房间"""
-    async with _lock:
-        _rooms[lecture_id].discard(websocket)
-        # 如果房间为空，清理字典
-        if not _rooms[lecture_id]:
-            del _rooms[lecture_id]
-            # 清理 seq 计数器（可选，保留也可以）
-            _seq_counters.pop(lecture_id, None)
+    """离开讲座房间，停止该连接的发送任务（未发出的消息丢弃）"""
+    async with _lock_for(lecture_id):
+        sender = _senders.pop(websocket, None)
+        if sender is None:
+            return  # 已离开（如发送任务先行清理），不重建房间
+        _send_queues.pop(websocket, None)
+        if sender is not asyncio.current_task():
+            sender.cancel()
+        room = tuple(ws for ws in _rooms.get(lecture_id, ()) if ws is not websocket)
+        if room:
+            _rooms[lecture_id] = room
+        else:
+            # 如果房间为空，清理字典
+            _rooms.pop(lecture_id, None)
+            # seq 计数器保留：字幕是批量异步落库的，此时可能还有记录在 writer 队列里，
+            # 重连时若从数据库重新读 MAX(seq) 会重复发号（翻译 upsert 会写到旧记录上）
+
+
+async def leave_current_room(websocket: WebSocket) -> None:
+    """离开连接当前所在的房间（join_room 时记录在 websocket.state.lecture_id），不在房间内则什么也不做"""
+    lecture_id = getattr(websocket.state, "lecture_id", None)
+    if lecture_id is not None:
+        await leave_room(lecture_id, websocket)
 
 
 async def broadcast(
     lecture_id: int,
-    message: dict[str, Any],
-    exclude: WebSocket | None = None,
-    timeout: float = 3.0
+    message: dict[str, Any] | str | Callable[[], dict[str, Any] | str],
+    exclude: WebSocket | None = None
 ) -> None:
     """
-    向讲座房间广播消息（带超时）
+    向讲座房间广播消息
+
+    只入队不等待发送完成：同一连接上的消息按广播顺序送达，发送超时/失败由发送任务处理；
+    发送队列已满的慢连接被移出房间并关闭，不拖慢其他连接
 
     Args:
         lecture_id: 讲座 ID
-        message: 消息内容
+        message: 消息内容（dict，或已由 encode_message 序列化好的文本，多次发送同一消息时可复用；
+                 也可传无参函数，房间里有接收者时才调用，省掉无人收听时构造/序列化消息的开销）
         exclude: 排除的连接（通常是发送方自己）
-        timeout: 发送超时（秒）
     """
-    # 获取当前房间的所有连接（需要加锁获取快照）
-    async with _lock:
-        room = _rooms.get(lecture_id)
-        if not room:
-            return
-        connections = list(room)
+    # 房间 tuple 只会被整体替换，无需加锁
+    room = _rooms.get(lecture_id)
+    if not room:
+        return
+
+    # 常见情况（ASR 字幕）不排除任何连接，直接遍历房间 tuple，循环内不再逐个比较
+    if exclude is None:
+        targets = room
+    elif len(room) == 1 and room[0] is exclude:
+        return  # 房间里只有发送方自己（如讲者先于听众连入），无需序列化
+    else:
+        targets = tuple(ws for ws in room if ws is not exclude)
+
+    # 整个房间只序列化一次
+    if callable(message):
+        message = message()
+    payload = message if isinstance(message, str) else encode_message(message)
+
+    slow: list[WebSocket] = []
+    for i in range(0, len(targets), BROADCAST_BATCH):
+        if i:
+            await asyncio.sleep(0)
+        _enqueue_all(targets[i:i + BROADCAST_BATCH], payload, slow)
+
+    await _evict_slow(lecture_id, slow)
+
+
+async def send_to(websocket: WebSocket, message: dict[str, Any] | str) -> None:
+    """
+    给单个连接发消息（经该连接的发送队列，与广播消息保持先后顺序，不会与发送任务同时写 socket）
+
+    连接不在房间内时丢弃；发送队列已满时与 broadcast 一样将其移出房间并关闭
+    """
+    queue = _send_queues.get(websocket)
+    if queue is None:
+        return
+    payload = message if isinstance(message, str) else encode_message(message)
+    try:
+        queue.put_nowait(payload)
+    except asyncio.QueueFull:
+        await _evict_slow(websocket.state.lecture_id, [websocket])
+
+
+def _enqueue_all(targets: tuple[WebSocket, ...], payload: str, slow: list[WebSocket]) -> None:
+    """把 payload 放进各连接的发送队列（同步，不让出事件循环），队列已满的连接追加到 slow"""
+    for ws in targets:
+        queue = _send_queues.get(ws)
+        if queue is not None:  # None：正在离开房间
+            try:
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                slow.append(ws)
 
-    # 并发发送（带超时）
-    async def _send_to_one(ws: WebSocket) -> WebSocket | None:
-        if ws is exclude:
-            return None
-        try:
-            await asyncio.wait_for(ws.send_json(message), timeout=timeout)
-            return None
-        except Exception as exc:
-            logger.warning(f"Failed to broadcast to client: {exc}")
-            return ws
 
-    # 并发发送所有消息
-    dead_connections = await asyncio.gather(
-        *[_send_to_one(ws) for ws in connections],
-        return_exceptions=True
-    )
+async def _evict_slow(lecture_id: int, slow: list[WebSocket]) -> None:
+    """清理跟不上的连接"""
+    for ws in slow:
+        logger.warning(f"Send queue full for a client in lecture {lecture_id}, disconnecting it")
+        await leave_room(lecture_id, ws)
+        _spawn(_close_quietly(ws, 1013, "Client too slow"))
 
-    # 清理失败的连接
-    for ws in dead_connections:
-        if isinstance(ws, WebSocket):
-            await leave_room(lecture_id, ws)
+
+def _spawn(coro: Any) -> None:
+    task = asyncio.create_task(coro)
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+
+def broadcast_partial(lecture_id: int, message: dict[str, Any]) -> None:
+    """
+    合并广播解码中的 partial 字幕
+
+    PARTIAL_COALESCE 秒内同一讲座的多次调用只广播最后一条（partial 是累计文本，后一条覆盖前一条）
+    """
+    _pending_partials[lecture_id] = message
+    if lecture_id not in _partial_timers:
+        loop = asyncio.get_running_loop()
+        _partial_timers[lecture_id] = loop.call_later(PARTIAL_COALESCE, _flush_partial, lecture_id)
+
+
+def _flush_partial(lecture_id: int) -> None:
+    """
+    定时器回调：同步入队到房间内所有连接
+
+    不另起 broadcast 任务——否则 discard_partial 之后该任务仍可能把过期的 partial 排在最终字幕后面
+    """
+    _partial_timers.pop(lecture_id, None)
+    message = _pending_partials.pop(lecture_id, None)
+    room = _rooms.get(lecture_id)
+    if message is None or not room:
+        return
+    slow: list[WebSocket] = []
+    _enqueue_all(room, encode_message(message), slow)
+    if slow:
+        _spawn(_evict_slow(lecture_id, slow))
+
+
+def discard_partial(lecture_id: int) -> None:
+    """丢弃尚未发出的 partial（最终字幕即将广播，过期的 partial 不应晚于它送达）"""
+    timer = _partial_timers.pop(lecture_id, None)
+    if timer is not None:
+        timer.cancel()
+    _pending_partials.pop(lecture_id, None)
 
 
 async def broadcast_translation_patch(lecture_id: int, seq: int, text_zh: str) -> None:
@@ -141,26 +385,37 @@ async def broadcast_translation_patch(lecture_id: int, seq: int, text_zh: str) -
         seq: 字幕序号
         text_zh: 中文翻译
     """
-    message = {
+    # 翻译晚于字幕到达，此时房间可能已空（讲者断开），延迟构造消息
+    await broadcast(lecture_id, lambda: {
         "type": "subtitle_zh",
         "lecture_id": lecture_id,
         "seq": seq,
         "text_zh": text_zh,
-    }
-    await broadcast(lecture_id, message)
+    })
 
 
-async def heartbeat(websocket: WebSocket, interval: float = 30.0) -> None:
+async def _heartbeat_loop(interval: float) -> None:
     """
-    心跳检测任务
+    全进程共享的心跳任务
 
-    每interval秒发送一次ping，客户端应回复pong
-    如果发送失败，任务退出（连接已断开）
+    每interval秒向所有在房间内的连接发送一次ping，客户端应回复pong；
+    ping 走各连接的发送队列，发送失败由发送任务负责清理连接
+
+    协议层 PING 由 uvicorn 负责（--ws-ping-interval）；这里的应用层 ping 是前端约定的
+    {"type":"ping"} 文本消息，内容固定，预先序列化一次
     """
-    try:
-        while True:
-            await asyncio.sleep(interval)
-            await websocket.send_json({"type": "ping"})
-    except Exception:
-        # 连接已断开，任务退出
-        pass
+    while True:
+        await asyncio.sleep(interval)
+        for queue in list(_send_queues.values()):
+            try:
+                queue.put_nowait(_PING)
+            except asyncio.QueueFull:
+                pass  # 队列已满的连接会在下次广播时被清理
+
+
+def stop_heartbeat() -> None:
+    """停止心跳任务（用于优雅退出）"""
+    global _heartbeat_task
+    if _heartbeat_task is not None:
+        _heartbeat_task.cancel()
+        _heartbeat_task = None
@@ -7,7 +7,7 @@ CREATE TABLE IF NOT EXISTS users (
     username VARCHAR(64) NOT NULL UNIQUE,
     password_hash VARCHAR(128) NOT NULL,  -- bcrypt hash
     role VARCHAR(16) NOT NULL DEFAULT 'user',  -- user|admin
-    token VARCHAR(128) UNIQUE,  -- Bearer token，可选JWT或随机串，唯一约束防授权混淆
+    token VARCHAR(128) UNIQUE,  -- Bearer token（token_urlsafe(32)，43字符；旧的64字符hex Token仍兼容），唯一约束防授权混淆
     created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
     disabled_at TIMESTAMPTZ  -- 软删除标记
 );